@@ -4,7 +4,7 @@ from anopheles_query import *
 
 
 
-for mod in ['env_data','validation_metrics','query_to_rec','brt_wrap']:
+for mod in ['caching','profiling','env_data','validation_metrics','query_to_rec','raster_store','raster_tiles','numpy_gbm','r_server','brt_wrap','partial_dependence','ensemble','brt_model','scheduler','work_queue']:
     try:
         exec('from %s import *'%mod)
     except ImportError:
@@ -0,0 +1,198 @@
+# Copyright (C) 2009  Anand Patil
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Fitted models as self-contained .npz files, and a small HTTP service that
+# scores batches of points against them. Neither needs R or the cache: the
+# file holds the unpacked stumps and everything needed to find the rasters.
+
+import os
+import json
+import BaseHTTPServer
+import numpy as np
+import pymc as pm
+from brt_wrap import brt_evaluator, get_names
+from env_data import check_grid, extract_points
+from raster_tiles import windowed_raster
+import raster_store
+
+__all__ = ['save_model', 'load_model', 'brt_model', 'model_set', 'serve_models']
+
+model_format = 1
+
+def save_model(fname, brt_evaluator, species_name, layer_names, glob_name, glob_channels):
+    """
+    Writes the stumps and intercept of brt_evaluator, and the rasters and
+    glob channels it takes its predictors from, to the .npz file fname.
+    The stumps of all predictors are concatenated, and predictor i's are
+    rows offsets[i] to offsets[i+1]. The raster names and the raster store
+    directory are made absolute, so the file can be served from anywhere.
+    """
+    names = get_names(layer_names, glob_name, glob_channels)
+    trees = [brt_evaluator.nice_tree_dict[n] for n in names]
+    counts = [0 if t is None else len(t) for t in trees]
+    column = lambda f: np.concatenate([np.zeros(0)] + [np.asarray(t[f], dtype='float') for t in trees if t is not None])
+    np.savez(fname, format=model_format, species_name=species_name, intercept=brt_evaluator.intercept,
+                predictors=np.array(names), layer_names=np.array(map(os.path.abspath, layer_names)),
+                glob_name=os.path.abspath(glob_name), glob_channels=np.array(glob_channels),
+                raster_store_dir=os.path.abspath(raster_store.raster_store_dir),
+                offsets=np.concatenate(([0], np.cumsum(counts))),
+                split_loc=column('split_loc'), left_val=column('left_val'), right_val=column('right_val'))
+
+class brt_model(object):
+    """
+    A model loaded by load_model. evaluator is a compiled brt_evaluator,
+    and layer_names, glob_name and glob_channels say where its predictors
+    come from. raster_store_dir is the raster store the rasters were
+    imported into when the model was saved, or None.
+    """
+    def __init__(self, species_name, evaluator, layer_names, glob_name, glob_channels, raster_store_dir=None):
+        self.species_name = species_name
+        self.evaluator = evaluator
+        self.layer_names = layer_names
+        self.glob_name = glob_name
+        self.glob_channels = glob_channels
+        self.raster_store_dir = raster_store_dir
+
+    def predict(self, x):
+        "Returns the probability of presence at the lon, lat points x, with NaN where a predictor is missing."
+        return model_set([self]).predict(x)[self.species_name]
+
+def load_model(fname):
+    "Reads a model written by save_model."
+    f = np.load(fname)
+    if int(f['format']) != model_format:
+        raise ValueError, 'Model %s is in format %s; this version reads format %i.'%(fname, f['format'], model_format)
+    offsets = f['offsets']
+    split_loc, left_val, right_val = f['split_loc'], f['left_val'], f['right_val']
+    nice_tree_dict = {}
+    for i, n in enumerate(f['predictors']):
+        s = slice(offsets[i], offsets[i+1])
+        nice_tree_dict[str(n)] = np.rec.fromarrays([split_loc[s], left_val[s], right_val[s]], names='split_loc,left_val,right_val') if offsets[i+1] > offsets[i] else None
+    layer_names = map(str, f['layer_names'])
+    glob_name = str(f['glob_name'])
+    glob_channels = list(f['glob_channels'])
+    # Files saved before the store directory was recorded use the default.
+    store_dir = str(f['raster_store_dir']) if 'raster_store_dir' in f.files else None
+    be = brt_evaluator(nice_tree_dict, float(f['intercept']), compiled=True, glob_name=glob_name, glob_channels=glob_channels)
+    return brt_model(str(f['species_name']), be, layer_names, glob_name, glob_channels, store_dir)
+
+class model_set(object):
+    """
+    Models for many species, scored together. The rasters are opened once,
+    memory-mapped where possible, and kept open. Species that share a glob
+    raster share one extraction, of the union of their layers, and the
+    glob channels are evaluated from the raw class codes.
+    """
+    def __init__(self, models):
+        self.models = dict([(m.species_name, m) for m in models])
+        self.rasters = {}
+
+    def raster(self, fname, store_dir=None):
+        if fname not in self.rasters:
+            self.rasters[fname] = windowed_raster(fname, store_dir)
+        return self.rasters[fname]
+
+    def predict(self, x, species=None):
+        """
+        Takes an (n,2) array of lon, lat in decimal degrees and a list of
+        species names, by default all of them. Returns a dictionary of
+        probabilities of presence by species, with NaN where a point is
+        off the rasters or masked in any that the species uses.
+        """
+        x = np.atleast_2d(np.asarray(x, dtype='float'))
+        if species is None:
+            species = self.models.keys()
+        for s in species:
+            if s not in self.models:
+                raise ValueError, 'There is no model for species %s.'%s
+
+        groups = {}
+        for s in species:
+            groups.setdefault(self.models[s].glob_name, []).append(self.models[s])
+
+        out = {}
+        for glob_name, models in groups.iteritems():
+            layer_names = []
+            for m in models:
+                layer_names += [l for l in m.layer_names if l not in layer_names]
+            # Models that share a glob raster were fitted by one run, so
+            # they share a raster store as well.
+            rasters = [self.raster(l, models[0].raster_store_dir) for l in layer_names + [glob_name]]
+            check_grid(layer_names, glob_name, rasters)
+            values = extract_points(rasters, x)
+            by_name = dict(zip(get_names(layer_names, glob_name, []), values[:-1]))
+
+            for m in models:
+                be = m.evaluator
+                pred_vars = dict([(n, by_name[n]) for n in get_names(m.layer_names, glob_name, [])])
+                pred_vars[be.raw_glob_name] = values[-1]
+                ok = ~np.any(np.isnan(pred_vars.values()), axis=0)
+                p = np.empty(len(x))
+                p.fill(np.nan)
+                if np.any(ok):
+                    p[ok] = pm.flib.invlogit(be(dict([(n, v[ok]) for n, v in pred_vars.iteritems()])))
+                out[m.species_name] = p
+        return out
+
+class model_request_handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    GET /species lists the species and their predictors. POST /predict
+    takes a JSON object with 'points', a list of [lon, lat] pairs, and
+    optionally 'species', a list of names, and returns a JSON object
+    mapping each species to a list of probabilities, with null where a
+    predictor is missing.
+    """
+    def reply(self, code, obj):
+        body = json.dumps(obj)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.rstrip('/') != '/species':
+            return self.reply(404, {'error': 'Unknown path %s.'%self.path})
+        self.reply(200, dict([(s, {'layers': m.layer_names, 'glob': m.glob_name, 'glob_channels': map(int, m.glob_channels)})
+                                for s, m in self.server.models.models.iteritems()]))
+
+    def do_POST(self):
+        if self.path.rstrip('/') != '/predict':
+            return self.reply(404, {'error': 'Unknown path %s.'%self.path})
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.getheader('Content-Length', 0))))
+            x = np.array(request['points'], dtype='float').reshape((-1,2))
+            probs = self.server.models.predict(x, request.get('species'))
+        except (ValueError, KeyError, TypeError), e:
+            return self.reply(400, {'error': '%s: %s'%(e.__class__.__name__, e)})
+        self.reply(200, dict([(s, [None if np.isnan(v) else float(v) for v in p]) for s, p in probs.iteritems()]))
+
+    def log_message(self, format, *args):
+        pass
+
+def serve_models(model_fnames, host='127.0.0.1', port=8642):
+    """
+    Loads the models in model_fnames and answers queries about them over
+    HTTP on host and port until interrupted. By default only this machine
+    can connect.
+    """
+    server = BaseHTTPServer.HTTPServer((host, port), model_request_handler)
+    server.models = model_set(map(load_model, model_fnames))
+    print 'Serving %i models on http://%s:%i/.'%(len(server.models.models), host, port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
@@ -1,17 +1,22 @@
 import numpy as np
 import os
-from env_data import extract_environment
+from env_data import extract_environment, extract_environment_batch
+from caching import anopheles_cache, fingerprint
+from raster_tiles import bbox_indices, rasterize_polygon, windowed_raster, flt_writer, map_writer
 from query_to_rec import sites_as_ndarray
-import map_utils
-import hashlib
-import warnings
+from numpy_gbm import gbm_step, numpy_gbm_result
+from profiling import profiled
+from r_server import r_workers
 import matplotlib
 import pymc as pm
 import cPickle
+import shutil
 from treetran import treetran
 matplotlib.use('pdf')
 import multiprocessing
-from pylab import rec2csv, csv2rec
+from multiprocessing.sharedctypes import RawArray
+from pylab import rec2csv
+import tables as tb
 
 def get_names(layer_names, glob_name, glob_channels):
     "Utility"
@@ -27,11 +32,86 @@ def df_to_ra(d):
     n = np.array(d.colnames)
     return np.rec.fromarrays(a, names=','.join(n))
 
-def get_pseudoabsences(eo, buffer_width, n_pseudoabsences, layer_names, glob_name):
-    fname = hashlib.sha1(cPickle.dumps(eo)+'_'+str(buffer_width)+'_'+str(n_pseudoabsences)).hexdigest()+'.npy'
-    if fname in os.listdir('anopheles-caches'):
-        pseudoabsences = np.load(os.path.join('anopheles-caches', fname))
-    else:
+def sample_pseudoabsences(region, template, n_pseudoabsences, seed=None, species_name=None):
+    """
+    Rasterizes region onto the template raster's grid, once, and draws
+    n_pseudoabsences distinct centroids of the unmasked pixels inside it 
+    uniformly at random, or all of them if there are fewer. Passing a seed 
+    makes the draw reproducible.
+    """
+    llclon, llclat, urclon, urclat = region.bounds
+    dx = template.lon[1]-template.lon[0]
+    dy = template.lat[1]-template.lat[0]
+    lon = template.lon + dx/2.
+    lat = template.lat + dy/2.
+
+    # Only the window of the template covering the region is read.
+    try:
+        llclati, llcloni, urclati, urcloni = bbox_indices(template.lon, template.lat, (llclat-dy, llclon-dx, urclat, urclon))
+    except IndexError:
+        raise ValueError, 'The pseudoabsence region of species %s, with bounds %s, is off the grid of %s.'%(species_name, region.bounds, template.fname)
+    cols = slice(llcloni, urcloni+1)
+    row_start = template.shape[0]-1-urclati
+    row_stop = template.shape[0]-llclati
+    
+    candidates = rasterize_polygon(region, lon[cols], lat[llclati:urclati+1]) & ~template.rows(row_start, row_stop, cols).mask
+    candidates = np.flatnonzero(candidates)
+    if len(candidates)==0:
+        raise ValueError, 'There are no unmasked pixels in the pseudoabsence region of species %s.'%species_name
+    if len(candidates) < n_pseudoabsences:
+        print 'Species %s: only %i unmasked pixels in the pseudoabsence region, so there are only %i pseudoabsences.'%(species_name, len(candidates), len(candidates))
+
+    draws = candidates[np.random.RandomState(seed).permutation(len(candidates))[:n_pseudoabsences]]
+    rows, cols = np.unravel_index(draws, (row_stop-row_start, urcloni+1-llcloni))
+    return np.array([lon[llcloni+cols], lat[template.shape[0]-1-(row_start+rows)]]).T
+
+def write_training_table(data, fname):
+    """
+    Writes a record array to an HDF5 file, one typed array per column,
+    so it can be read back exactly and without any text parsing.
+    """
+    hf = tb.openFile(fname,'w')
+    hf.createGroup('/','columns')
+    for n in data.dtype.names:
+        hf.createArray('/columns', n, np.ascontiguousarray(data[n]))
+    hf.root.columns._v_attrs.names = list(data.dtype.names)
+    hf.close()
+
+def load_training_table(fname):
+    """
+    Reads a table written by write_training_table from the cache as a 
+    record array. The column names are lowercased, as in get_names.
+    """
+    hf = tb.openFile(anopheles_cache.path(fname))
+    names = hf.root.columns._v_attrs.names
+    arrays = [hf.getNode('/columns', n)[:] for n in names]
+    hf.close()
+    return np.rec.fromarrays(arrays, names=','.join(map(str.lower, names)))
+
+def training_table_to_r(path):
+    """
+    Converts a table written by write_training_table to an R data frame
+    through rpy2's NumPy conversion, keeping the original column names.
+    """
+    from rpy2 import robjects
+    from rpy2.robjects.numpy2ri import numpy2ri
+    from rpy2.rlike.container import OrdDict
+    hf = tb.openFile(path)
+    names = hf.root.columns._v_attrs.names
+    df = robjects.DataFrame(OrdDict([(n, numpy2ri(hf.getNode('/columns', n)[:])) for n in names]))
+    hf.close()
+    return df
+
+@profiled('get_pseudoabsences', count=len)
+def get_pseudoabsences(eo, buffer_width, n_pseudoabsences, layer_names, glob_name, seed=None, species_name=None):
+    # Draws made with replacement, before they were made without, have other keys.
+    fname = fingerprint(cPickle.dumps(eo), buffer_width, n_pseudoabsences, seed, 'distinct')+'.npy'
+    key_lock = anopheles_cache.lock(fname)
+    key_lock.acquire()
+    try:
+        if fname in anopheles_cache:
+            return np.load(anopheles_cache.path(fname))
+
         if buffer_width >= 0:
             buff = eo.buffer(buffer_width)
             diff_buffer = buff.difference(eo)
@@ -45,67 +125,59 @@ def get_pseudoabsences(eo, buffer_width, n_pseudoabsences, layer_names, glob_nam
         else:
             template = glob_name
 
-        lon, lat, test_raster, rtype = map_utils.import_raster(*os.path.split(template)[::-1])
-        # Right the raster
-        test_raster = map_utils.grid_convert(test_raster,'y-x+','x+y+')
-        # Convert lower-left coords to centroids
-        lon += (lon[1]-lon[0])/2.
-        lat += (lat[1]-lat[0])/2.
-    
-        def testfn(lon_test,lat_test,r=test_raster,lon=lon,lat=lat):
-            lon_ind = np.argmin(np.abs(lon-lon_test))
-            lat_ind = np.argmin(np.abs(lat-lat_test))
-            return True-test_raster.mask[lon_ind,lat_ind]
-    
-        pseudoabsences = np.vstack(map_utils.shapefile_utils.multipoly_sample(n_pseudoabsences, diff_buffer, test=testfn)).T
-        if not np.all([testfn(l1,l2) for l1,l2 in pseudoabsences]):
-            raise ValueError, 'Test failed for some pseudoabsences.'
-        np.save(os.path.join('anopheles-caches',fname), pseudoabsences)
+        pseudoabsences = sample_pseudoabsences(diff_buffer, windowed_raster(template), n_pseudoabsences, seed, species_name)
+        anopheles_cache.write(fname, lambda f: np.save(f, pseudoabsences))
         
-    return pseudoabsences
+        return pseudoabsences
+    finally:
+        key_lock.release()
     
     
-def sites_and_env(session, species, layer_names, glob_name, glob_channels, buffer_width, n_pseudoabsences, dblock=None, simdata=False):
+def sites_and_env(session, species, layer_names, glob_name, glob_channels, buffer_width, n_pseudoabsences, simdata=False, seed=None):
     """
     Queries the DB to get a list of locations. Writes it out along with matching 
-    extractions of the requested layers to a temporary csv file, which serves the 
-    dual purpose of caching the extraction and making it easier to get data into 
-    the BRT package.
+    extractions of the requested layers to a binary table in the cache, which 
+    serves the dual purpose of caching the extraction and making it easier to 
+    get data into the BRT package.
     """
 
     breaks, x, found, zero, others_found, multipoints, eo = sites_as_ndarray(session, species)
-    
+
     if simdata:
         print 'Process %i simulating presences for species %s.'%(multiprocessing.current_process().ident,species[1])
-        x = get_pseudoabsences(eo, -1, n_pseudoabsences, layer_names, glob_name)
-        found = np.ones(n_pseudoabsences)
-        
+        x = get_pseudoabsences(eo, -1, n_pseudoabsences, layer_names, glob_name, seed, species[1])
+        breaks = np.arange(len(x)+1)
+        found = np.ones(len(x))
+
+
+    pseudoabsences = get_pseudoabsences(eo, buffer_width, n_pseudoabsences, layer_names, glob_name, seed, species[1])
 
-    fname = hashlib.sha1(str(x)+found.tostring()+\
-            glob_name+'channel'.join([str(i) for i in glob_channels])+\
-            'layer'.join(layer_names)).hexdigest()+'.csv'
-            
-    pseudoabsences = get_pseudoabsences(eo, buffer_width, n_pseudoabsences, layer_names, glob_name)        
-            
-    x_found = x[np.where(found)]
+    # found has an entry per site, and x a row per point, so the sites'
+    # flags are repeated over their points.
+    points_per_site = np.diff(breaks)
+    if len(found) != len(points_per_site) or breaks[-1] != len(x):
+        raise ValueError, 'Species %s has %i sites and %i points, but its breaks are for %i sites and %i points.'%(species[1], len(found), len(x), len(points_per_site), breaks[-1])
+    x_found = x[np.repeat(found, points_per_site) > 0]
+    if len(x_found) != points_per_site[found > 0].sum():
+        raise ValueError, 'Species %s has %i points in sites where it was found, but %i presence rows.'%(species[1], points_per_site[found > 0].sum(), len(x_found))
 
     x = np.vstack((x_found, pseudoabsences))
-    found = np.concatenate((np.ones(len(x_found)), np.zeros(n_pseudoabsences)))
+    found = np.concatenate((np.ones(len(x_found)), np.zeros(len(pseudoabsences))))
 
-    if fname in os.listdir('anopheles-caches'):
-        pass
-    else:
+    fname = fingerprint(x, found, glob_name, list(glob_channels), list(layer_names))+'.hdf5'
+    key_lock = anopheles_cache.lock(fname)
+    key_lock.acquire()
+    try:
+        if fname in anopheles_cache:
+            return fname, pseudoabsences, x
 
         # Makes list of (key, value) tuples
-        env_layers = map(lambda ln: extract_environment(ln, x, lock=dblock), layer_names)\
-                + map(lambda ch: (os.path.basename(glob_name)+'_'+str(ch), extract_environment(glob_name,x,\
-                    postproc=lambda d: d==ch, id_=ch, lock=dblock)[1]), glob_channels)
+        env_layers, nancheck = extract_environment_batch(layer_names, glob_name, glob_channels, x)
 
         arrays = [(found>0).astype('int')] + [l[1] for l in env_layers]
         names = ['found'] + [l[0] for l in env_layers]
 
         data = np.rec.fromarrays(arrays, names=','.join(names))
-        nancheck = np.array([np.any(np.isnan(row.tolist())) for row in data])
         if np.any(nancheck):
             print 'There were some NaNs in the data, probably points in the sea'
 
@@ -117,7 +189,9 @@ def sites_and_env(session, species, layer_names, glob_name, glob_channels, buffe
             raise ValueError, 'All environmental layer evaluations contained only single values.'
         
         data = data[np.where(True-nancheck)]
-        rec2csv(data, os.path.join('anopheles-caches',fname))
+        anopheles_cache.write(fname, lambda f: write_training_table(data, f))
+    finally:
+        key_lock.release()
 
     return fname, pseudoabsences, x
 
@@ -136,6 +210,8 @@ def unpack_gbm_object(brt_results, *names):
     return map(lambda n: maybe_array(brt_results[np.where(namelist==n)[0][0]]), names)
     
 def print_gbm_object(brt_results, *names):
+    if isinstance(brt_results, numpy_gbm_result):
+        return map(lambda n: getattr(brt_results, 'printed', {}).get(n, str(brt_results[brt_results.names.index(n)])), names)
     namelist = np.array(brt_results.names)
     return map(lambda n: str(brt_results[np.where(namelist==n)[0][0]]), names)
 
@@ -146,6 +222,15 @@ def unpack_brt_trees(brt_results, layer_names, glob_name, glob_channels):
     associated with the corresponding predictors.
     """
     all_names = get_names(layer_names, glob_name, glob_channels)
+
+    if isinstance(brt_results, numpy_gbm_result) and brt_results.stumps is not None:
+        # The NumPy backend keeps its stumps in this layout already.
+        stumps = brt_results.stumps
+        nice_tree_dict = {}
+        for i, v in enumerate(all_names):
+            trees = stumps[stumps.predictor==i]
+            nice_tree_dict[v] = np.rec.fromarrays([trees.split_loc, trees.left_val, trees.right_val], names='split_loc,left_val,right_val') if len(trees) else None
+        return nice_tree_dict
     
     tree_matrix = unpack_gbm_object(brt_results, 'trees')[0]
     nice_trees = []
@@ -166,51 +251,161 @@ def unpack_brt_trees(brt_results, layer_names, glob_name, glob_channels):
                 
     return nice_tree_dict
 
+@profiled('brt')
 def brt(fname, species_name, gbm_opts):
     """
-    Takes the name of a CSV file containing a data frame and a dict
+    Takes the name of a training table written by sites_and_env and a dict
     of options for gbm.step, runs gbm.step, and returns the results.
+
+    If gbm_opts['backend'] is 'numpy', the model is fit by numpy_gbm.gbm_step
+    without starting R, and the results are a numpy_gbm_result. The
+    option 'seed' seeds its folds and bags.
+
+    Otherwise gbm.step is run by r_server.fit_gbm_step, through r_workers, 
+    and the gbm.object comes back as a numpy_gbm_result too. The option
+    'seed' is passed to R's set.seed just before gbm.step. The option
+    'fold.processes' is for the numpy backend only, and is not passed to
+    gbm.step; its cross-validation folds are fitted one after another.
+    """
+    gbm_opts = dict(gbm_opts)
+    backend = gbm_opts.pop('backend', 'R')
+    if backend == 'numpy':
+        seed = gbm_opts.pop('seed', None)
+        brt_fname = fingerprint(backend, fname, sorted(gbm_opts.items()), seed)+'.pickle'
+        key_lock = anopheles_cache.lock(brt_fname)
+        key_lock.acquire()
+        try:
+            if brt_fname in anopheles_cache:
+                return cPickle.load(file(anopheles_cache.path(brt_fname)))
+            res = gbm_step(load_training_table(fname), gbm_opts, seed)
+            anopheles_cache.write(brt_fname, lambda f: cPickle.dump(res, file(f,'w'), 2))
+            return res
+        finally:
+            key_lock.release()
+    elif backend != 'R':
+        raise ValueError, 'Unknown BRT backend %s; should be R or numpy.'%backend
+
+    # gbm.step runs in one of the warm R workers if r_workers has any, or 
+    # else in this process, in a fresh R environment either way. The 
+    # gbm.object is cached both as R saved it, for write_brt_results, and 
+    # converted to NumPy, so that cache hits do not need R.
+    gbm_opts.pop('fold.processes', None)
+    seed = gbm_opts.pop('seed', None)
+    opt_argstr = ', '.join(map(lambda t: '%s=%s'%t, sorted(gbm_opts.iteritems())))
+    brt_fname = fingerprint(*[fname, opt_argstr] + ([seed] if seed is not None else []))+'.pickle'
+    key_lock = anopheles_cache.lock(brt_fname)
+    key_lock.acquire()
+    try:
+        if brt_fname in anopheles_cache:
+            return cPickle.load(file(anopheles_cache.path(brt_fname)))
+        res = []
+        anopheles_cache.write(r_object_key(brt_fname), lambda f: res.append(r_workers.fit(os.path.abspath(anopheles_cache.path(fname)), opt_argstr, os.path.abspath(f), seed)))
+        res = res[0]
+        res.r_object = r_object_key(brt_fname)
+        anopheles_cache.write(brt_fname, lambda f: cPickle.dump(res, file(f,'w'), 2))
+        return res
+    finally:
+        key_lock.release()
+
+def r_object_key(brt_fname):
+    "The cache key of the R save file of the gbm.object cached under brt_fname."
+    return os.path.splitext(brt_fname)[0]+'.r'
+
+def compile_trees(trees):
+    """
+    Collapses all the stumps splitting on a single predictor into one
+    piecewise-constant function. Returns the sorted unique split points
+    and a table of function values, such that the summed contribution of
+    the stumps at v is table[np.searchsorted(splits, v, side='right')].
+    """
+    splits = np.unique(trees.split_loc)
+    # A stump contributes left_val where v < split_loc and right_val otherwise.
+    # Start from the sum of the right values, which applies above every split,
+    # and add left_val - right_val for each split that is still above v.
+    step = np.bincount(np.searchsorted(splits, trees.split_loc), weights=trees.left_val - trees.right_val, minlength=len(splits)+1)
+    table = np.cumsum(step[::-1])[::-1] + np.sum(trees.right_val)
+    return splits, table
+
+def glob_lookup_table(channel_trees):
+    """
+    Takes a dictionary mapping glob class codes to the stumps on the 
+    corresponding indicator variables, and returns a table whose i'th 
+    element is the summed contribution of every channel at a pixel of 
+    class i. The last element is the contribution at pixels whose class 
+    is not a channel.
     """
-    from rpy2.robjects import r
-    import anopheles_brt
-    r.source(os.path.join(anopheles_brt.__path__[0],'brt.functions.R'))
+    f = {}
+    for ch, trees in channel_trees.iteritems():
+        if trees is None:
+            continue
+        if int(ch) != ch or ch < 0:
+            raise ValueError, 'Glob channel %s is not a nonnegative integer class code.'%ch
+        # The indicator is 0 everywhere but at pixels of class ch.
+        splits, table = compile_trees(trees)
+        f[int(ch)] = table[np.searchsorted(splits, [0., 1.], side='right')]
     
-    heads = file(os.path.join('anopheles-caches',fname)).readline().split(',')
-    base_argstr = 'data=read.csv("anopheles-caches/%s"), gbm.x=2:%i, gbm.y=1, family="bernoulli", silent=TRUE'%(fname, len(heads))
-    opt_argstr = ', '.join([base_argstr] + map(lambda t: '%s=%s'%t, gbm_opts.iteritems()))
-
-    varname = sanitize_species_name(species_name)
-
-    brt_fname = hashlib.sha1(opt_argstr).hexdigest()+'.r'
-    if brt_fname in os.listdir('anopheles-caches'):
-        r('load')(os.path.join('anopheles-caches', brt_fname))
-        return r(varname)
-    else:
-        r('%s<-gbm.step(%s)'%(varname,opt_argstr))
-        if str(r(varname))=='NULL':
-            raise ValueError, 'gbm.step returned NULL'
-        r('save(%s, file="%s")'%(varname,os.path.join('anopheles-caches', brt_fname)))
-        return r(varname)
+    lut = np.empty(max(f.keys()+[-1])+2)
+    lut.fill(np.sum([v[0] for v in f.itervalues()]))
+    for ch, (f0, f1) in f.iteritems():
+        lut[ch] += f1 - f0
+    return lut
 
 class brt_evaluator(object):
     """
     A lexical closure. Once created, takes predictive variables
     as a dictionary as an argument and returns a prediction on the
     corresponding grid.
+    
+    If compiled is True, each predictor's stumps are collapsed into a
+    single step function by compile_trees, and evaluated with one binary 
+    search per pixel rather than one comparison per tree.
+    
+    If glob_name and glob_channels are given, the glob raster's class codes
+    can be supplied under the key raw_glob_name in place of one indicator 
+    array per channel. All the channels are then evaluated with a single 
+    lookup in a table made by glob_lookup_table.
     """
-    def __init__(self, nice_tree_dict, intercept):
+    def __init__(self, nice_tree_dict, intercept, compiled=False, glob_name=None, glob_channels=[]):
         self.nice_tree_dict = dict(map(lambda t: (str.lower(t[0]), t[1]), nice_tree_dict.iteritems()))
         self.intercept = intercept
+        self.compiled = compiled
+        if compiled:
+            self.compiled_tree_dict = dict([(n, compile_trees(trees)) for n, trees in self.nice_tree_dict.iteritems() if trees is not None])
+        
+        self.raw_glob_name = None
+        self.glob_channel_names = set()
+        if glob_name is not None:
+            self.raw_glob_name = str.lower(os.path.basename(glob_name))
+            channel_names = get_names([], glob_name, glob_channels)
+            self.glob_channel_names = set(channel_names)
+            self.glob_lut = glob_lookup_table(dict([(ch, self.nice_tree_dict[n]) for ch, n in zip(glob_channels, channel_names)]))
+            self.raw_glob_names = set(self.nice_tree_dict.keys()) - self.glob_channel_names | set([self.raw_glob_name])
+
     def __call__(self, pred_vars):
-        if set(pred_vars.keys()) != set(self.nice_tree_dict.keys()):
+        raw_glob = self.raw_glob_name is not None and self.raw_glob_name in pred_vars
+        if set(pred_vars.keys()) != (self.raw_glob_names if raw_glob else set(self.nice_tree_dict.keys())):
             raise ValueError, "You haven't supplied all the predictors."
         out = np.empty(len(pred_vars.values()[0]))
         out.fill(self.intercept)
-        N = 0.
+        if raw_glob:
+            codes = np.asarray(pred_vars[self.raw_glob_name])
+            i = codes.astype('int')
+            i[(i<0) | (i>=len(self.glob_lut)-1) | (i!=codes)] = len(self.glob_lut)-1
+            out += self.glob_lut[i]
+            skip = self.glob_channel_names
+        else:
+            skip = ()
+        if self.compiled:
+            for n, (splits, table) in self.compiled_tree_dict.iteritems():
+                if n in skip:
+                    continue
+                # treetran works in double precision, so do the same here.
+                v = np.asarray(pred_vars[n], dtype='float64')
+                out += table[np.searchsorted(splits, v, side='right')]
+            return out
         for n, trees in self.nice_tree_dict.iteritems():
-            if trees is None:
+            if trees is None or n in skip:
                 continue
-            N += len(trees)
             treetran(trees.split_loc, trees.left_val, trees.right_val, pred_vars[n], out)
         return out
 
@@ -220,7 +415,7 @@ def brt_doublecheck(fname, brt_evaluator, brt_results):
     with that stored in the gbm.object.
     """
     ures = unpack_gbm_object(brt_results, 'fit')
-    data = csv2rec(os.path.join('anopheles-caches', fname))
+    data = load_training_table(fname)
     ddict = dict([(k, data[k]) for k in data.dtype.names[1:]])
     out = brt_evaluator(ddict)
 
@@ -241,28 +436,74 @@ def write_brt_results(brt_results, species_name, result_names):
     a results directory, and also some requested elements of it as
     flat text files.
     """
-    from rpy2.robjects import r
-
     result_dirname = get_result_dir(species_name)
-    varname = sanitize_species_name(species_name)
-    r('save(%s, file="%s")'%(varname,os.path.join(result_dirname, 'gbm.object.r')))
+    cPickle.dump(brt_results, file(os.path.join(result_dirname, 'gbm.object.pickle'),'w'), 2)
+    if brt_results.stumps is None:
+        # Fitted by R, so R's own copy is in the cache too.
+        r_fname = getattr(brt_results, 'r_object', None)
+        if r_fname is not None and r_fname in anopheles_cache:
+            shutil.copyfile(anopheles_cache.path(r_fname), os.path.join(result_dirname, 'gbm.object.r'))
     
     results = print_gbm_object(brt_results, *result_names)
     for n,v in zip(result_names, results):
         file(os.path.join(result_dirname, n+'.txt'),'w').write(str(v))
-        
-def subset_raster(r, llclati, llcloni, urclati, urcloni):
-    r_ = map_utils.grid_convert(r,'y-x+','x+y+')
-    return map_utils.grid_convert(r_[llcloni:urcloni,llclati:urclati],'x+y+','y-x+').astype('float32')
-    
+
+def gbm_element(brt_results, *path):
+    """
+    Retrieves a scalar nested in a gbm.object from either backend,
+    e.g. gbm_element(brt_results, 'cv.statistics', 'deviance.se').
+    """
+    out = brt_results
+    for n in path:
+        if isinstance(out, dict):
+            out = out[n]
+        else:
+            out = out[list(out.names).index(n)]
+    return np.asarray(out).ravel()[0]
+
+@profiled('simplify_predictors')
+def simplify_predictors(fname, brt_results, species_name, layer_names, glob_name, glob_channels, gbm_opts, n_drops='auto', alpha=1, n_processes=1, seed=None):
+    """
+    Runs backward elimination of predictors with numpy_gbm.gbm_simplify on
+    the training table and the number of trees chosen by gbm.step. Writes
+    the change in deviance with each drop and the order of the drops to the
+    results directory, and returns layer_names and glob_channels without
+    the predictors that are recommended for dropping. With two predictors
+    or fewer, or n_drops=0, nothing is dropped and they come back as they are.
+    """
+    from numpy_gbm import gbm_simplify
+
+    gbm_opts = dict(gbm_opts)
+    for k in ['backend','seed']:
+        gbm_opts.pop(k, None)
+    n_trees = int(gbm_element(brt_results, 'gbm.call', 'best.trees'))
+    deviance_se = gbm_element(brt_results, 'cv.statistics', 'deviance.se')
+
+    data = load_training_table(fname)
+    simp = gbm_simplify(data, gbm_opts, n_trees, deviance_se, n_drops, alpha, seed, n_processes)
+
+    result_dirname = get_result_dir(species_name)
+    summary = simp['deviance.summary']
+    rec2csv(np.rec.fromarrays([np.arange(1,len(summary)+1), summary.mean, summary.se], names='drops,mean,se'), os.path.join(result_dirname,'simplify-deviance.csv'))
+    rec2csv(simp['drop.count'], os.path.join(result_dirname,'simplify-drop-count.csv'))
+    file(os.path.join(result_dirname,'simplify-drops.txt'),'w').write('\n'.join(simp['final.drops'][:simp['n.drops']]))
+
+    # The predictor columns of the training table are the layers followed by the glob channels.
+    dropped = set(simp['final.drops'][:simp['n.drops']])
+    keep = [n not in dropped for n in data.dtype.names[1:]]
+    new_layer_names = [l for l, k in zip(layer_names, keep[:len(layer_names)]) if k]
+    new_glob_channels = [c for c, k in zip(glob_channels, keep[len(layer_names):]) if k]
+    return new_layer_names, new_glob_channels
+
+@profiled('trees_to_diagnostics')
 def trees_to_diagnostics(brt_evaluator, fname, species_name):
     """
     Takes the BRT evaluator and sees how well it does at predicting the training dataset.
     """
 
-    from diagnostics import simple_assessments, roc, plot_roc_
+    from diagnostics import simple_assessments, confusion_counts, assessments_at_thresholds, roc, plot_roc_
 
-    din = csv2rec(os.path.join('anopheles-caches',fname))
+    din = load_training_table(fname)
     found = din.found
     din = dict([(k,din[k]) for k in brt_evaluator.nice_tree_dict.iterkeys()])
     probs = pm.flib.invlogit(brt_evaluator(din))
@@ -275,8 +516,9 @@ def trees_to_diagnostics(brt_evaluator, fname, species_name):
     for f in simple_assessments:
         resdict[f.__name__] = f(probs>.5, found)
 
-    pstack = np.array([pm.rbernoulli(probs) for i in xrange(10000)])
-    fp, tp, AUC = roc(pstack, found)
+    # The probabilities are sorted once, for the ROC curve and the thresholds.
+    counts = confusion_counts(probs, found)
+    fp, tp, AUC = roc(probs, found, counts)
     resdict['AUC'] = AUC
     
     fout=file(os.path.join(result_dirname,'simple-diagnostics.txt'),'w')
@@ -292,48 +534,205 @@ def trees_to_diagnostics(brt_evaluator, fname, species_name):
     
     r = np.rec.fromarrays([fp,tp],names='false,true')
     rec2csv(r,os.path.join(result_dirname,'roc.csv'))
+    
+    thresholds, curves = assessments_at_thresholds(probs, found, counts)
+    names = sorted(curves.keys())
+    r = np.rec.fromarrays([thresholds]+[curves[n] for n in names], names=','.join(['threshold']+names))
+    rec2csv(r,os.path.join(result_dirname,'threshold-diagnostics.csv'))
 
 
-def trees_to_map(brt_evaluator, species_name, layer_names, glob_name, glob_channels, bbox, memlim = 4e9):
+@profiled('trees_to_map', count=lambda r: len(r[0])*len(r[1]), unit='pixels')
+def trees_to_map(brt_evaluator, species_name, layer_names, glob_name, glob_channels, bbox, tile_rows=256):
     """
-    Makes maps and writes them out in flt format.
+    Makes a map and returns the lon and lat vectors and the map, as a masked
+    array in the 'y-x+' view. The rasters are read tile_rows rows at a time
+    like trees_to_map_tiled, so only the map itself is held in full.
     """
-    all_names = get_names(layer_names, glob_name, glob_channels)
-    short_layer_names = all_names[:len(layer_names)]
-    short_glob_names = all_names[len(layer_names):]
-    result_dirname = get_result_dir(species_name)
-    
-    llclat,llclon,urclat,urclon = bbox
-    
-    rasters = {}
+    tiles = map_tiles(layer_names, glob_name, glob_channels, bbox, tile_rows, raw_glob=brt_evaluator.raw_glob_name is not None)
+
+    out_raster = np.ma.empty((len(tiles.lat), len(tiles.lon)), dtype='float32')
+    for start, glob, where_notmask, rasters in tiles:
+        out_tile = glob.astype('float32')
+        if len(where_notmask[0]) > 0:
+            out_tile[where_notmask] = pm.flib.invlogit(brt_evaluator(rasters))
+        out_raster[start:start+len(out_tile)] = out_tile
 
-    n_rasters = len(layer_names)+len(glob_channels)
-    lon,lat,glob,t = map_utils.import_raster(*os.path.split(glob_name)[::-1])
+    return tiles.lon, tiles.lat, out_raster
+
+class map_tiles(object):
+    """
+    Iterates over the part of the rasters inside a bounding box a window of
+    tile_rows rows at a time, so that only one window of each raster is in
+    memory at once. Each iteration yields the tile's first row in the output
+    map, the tile of the glob raster, the indices of its unmasked pixels and
+    a dictionary of predictor values at those pixels suitable for 
+    brt_evaluator.
     
-    orig_glob_shape = glob.shape
+    If raw_glob is True, the dictionary holds the glob class codes under 
+    the glob raster's name instead of one indicator array per channel.
+    """
+    def __init__(self, layer_names, glob_name, glob_channels, bbox, tile_rows=256, raw_glob=False):
+        all_names = get_names(layer_names, glob_name, glob_channels)
+        self.short_layer_names = all_names[:len(layer_names)]
+        self.short_glob_names = all_names[len(layer_names):]
+        self.glob_channels = glob_channels
+        self.tile_rows = tile_rows
+        self.raw_glob = raw_glob
+        self.raw_glob_name = str.lower(os.path.basename(glob_name))
+        self.names = self.short_layer_names + ([self.raw_glob_name] if raw_glob else self.short_glob_names)
+
+        self.glob = windowed_raster(glob_name)
+        self.layers = map(windowed_raster, layer_names)
+        for n, l in zip(self.short_layer_names, self.layers):
+            if l.shape != self.glob.shape:
+                raise ValueError, 'Shape of raster %s does not match shape of Glob raster. Check config file.'%n
+
+        llclati, llcloni, urclati, urcloni = bbox_indices(self.glob.lon, self.glob.lat, bbox)
+        self.lon = self.glob.lon[llcloni:urcloni]
+        self.lat = self.glob.lat[llclati:urclati]
+        # Rows are stored north to south, so latitude index i is row nrows-1-i.
+        self.row_start = self.glob.shape[0]-urclati
+        self.row_stop = self.glob.shape[0]-llclati
+        self.cols = slice(llcloni, urcloni)
+
+    def __iter__(self):
+        for start in xrange(self.row_start, self.row_stop, self.tile_rows):
+            stop = min(start+self.tile_rows, self.row_stop)
+            glob = self.glob.rows(start, stop, self.cols)
+            where_notmask = np.where(~glob.mask)
+            rasters = {}
+            if self.raw_glob:
+                rasters[self.raw_glob_name] = glob.data[where_notmask]
+            else:
+                for n, ch in zip(self.short_glob_names, self.glob_channels):
+                    rasters[n] = (glob.data==ch)[where_notmask]
+            for n, l in zip(self.short_layer_names, self.layers):
+                rasters[n] = l.rows(start, stop, self.cols).data[where_notmask]
+            yield start-self.row_start, glob, where_notmask, rasters
+
+@profiled('trees_to_maps_tiled', count=lambda r: len(r[0])*len(r[1]), unit='pixels')
+def trees_to_maps_tiled(brt_evaluators, layer_names, glob_name, glob_channels, bbox, tile_rows=256, map_format='flt'):
+    """
+    Makes maps for many species in a single pass over the rasters. Takes a
+    dictionary mapping species names to evaluators; layer_names and 
+    glob_channels should be the union of the predictors the evaluators use.
+    Each tile is read once and passed through every evaluator, and each 
+    species' map is written to probability-map.flt in its results directory,
+    or to probability-map.h5, with overviews, if map_format is 'h5'.
+    Returns the lon and lat vectors and a dictionary of filenames.
+    """
+    raw_glob = np.all([be.raw_glob_name is not None for be in brt_evaluators.itervalues()])
+    tiles = map_tiles(layer_names, glob_name, glob_channels, bbox, tile_rows, raw_glob)
     
-    llclati = np.where(lat>=llclat)[0][0]
-    llcloni = np.where(lon>=llclon)[0][0]
-    urclati = np.where(lat<=urclat)[0][-1]
-    urcloni = np.where(lon<=urclon)[0][-1]    
+    pred_names = dict([(k, be.raw_glob_names if raw_glob else set(be.nice_tree_dict.keys())) for k, be in brt_evaluators.iteritems()])
+    outs = {}
+    for species_name, be in brt_evaluators.iteritems():
+        if not pred_names[species_name] <= set(tiles.names):
+            raise ValueError, 'Species %s uses predictors that are not among the requested layers and channels.'%species_name
+        outs[species_name] = map_writer(os.path.join(get_result_dir(species_name), 'probability-map.flt'), tiles.lon, tiles.lat, map_format)
     
-    glob = subset_raster(glob, llclati, llcloni, urclati, urcloni)
-    where_notmask = np.where(True-glob.mask)
-    raster_size = np.prod(glob.shape)*4
-    if raster_size * n_rasters > memlim:
-        warnings.warn('Species %s: Generating this map would require too much memory. Make the bounding box smaller.'%species_name)
+    for start, glob, where_notmask, rasters in tiles:
+        for species_name, be in brt_evaluators.iteritems():
+            out_tile = glob.astype('float32')
+            if len(where_notmask[0]) > 0:
+                out_tile[where_notmask] = pm.flib.invlogit(be(dict([(k, rasters[k]) for k in pred_names[species_name]])))
+            outs[species_name].write_rows(start, out_tile)
+
+    [out.close() for out in outs.itervalues()]
+    return tiles.lon, tiles.lat, dict([(k, out.fname) for k, out in outs.iteritems()])
+
+def trees_to_map_tiled(brt_evaluator, species_name, layer_names, glob_name, glob_channels, bbox, tile_rows=256, map_format='flt'):
+    """
+    Like trees_to_map, but streams the rasters through map_tiles and writes 
+    each tile of the map straight into probability-map.flt, or .h5 if
+    map_format is 'h5', in the results directory. Peak memory depends on 
+    tile_rows rather than on the size of the bounding box. Returns the lon 
+    and lat vectors and the filename.
+    """
+    lon, lat, fnames = trees_to_maps_tiled({species_name: brt_evaluator}, layer_names, glob_name, glob_channels, bbox, tile_rows, map_format)
+    return lon, lat, fnames[species_name]
+
+def batch_trees_to_maps(map_inputs, tile_rows=256, map_format='flt'):
+    """
+    Takes a list of (species_name, brt_evaluator, layer_names, glob_name, 
+    glob_channels, bbox) tuples. Groups them by glob raster, and makes each
+    group's maps with trees_to_maps_tiled over the union of the group's 
+    predictors and bounding boxes.
+    """
+    groups = {}
+    for m in map_inputs:
+        groups.setdefault(m[3], []).append(m)
     
-    for n, ch in zip(short_glob_names, glob_channels):
-        rasters[n] = (glob==ch)[where_notmask]    
-
-    for n, p in zip(short_layer_names, layer_names):
-        lon,lat,data,t = map_utils.import_raster(*os.path.split(p)[::-1])
-        if data.shape != orig_glob_shape:
-            raise ValueError, 'Shape of raster %s does not match shape of Glob raster for species %s. Check config file.'%(n,species_name)
-        rasters[n] = subset_raster(data, llclati, llcloni, urclati, urcloni)[where_notmask]
+    fnames = {}
+    for glob_name, group in groups.iteritems():
+        layer_names = []
+        glob_channels = []
+        for species_name, be, ln, gn, gc, bbox in group:
+            layer_names += [l for l in ln if l not in layer_names]
+            glob_channels += [c for c in gc if c not in glob_channels]
+        bboxes = np.array([m[5] for m in group])
+        bbox = (bboxes[:,0].min(), bboxes[:,1].min(), bboxes[:,2].max(), bboxes[:,3].max())
         
-    ravelledmap = brt_evaluator(rasters)
-    out_raster = glob.astype('float32')
-    out_raster[where_notmask] = pm.flib.invlogit(ravelledmap)
+        evaluators = dict([(m[0], m[1]) for m in group])
+        fnames.update(trees_to_maps_tiled(evaluators, layer_names, glob_name, glob_channels, bbox, tile_rows, map_format)[2])
+
+    return fnames
+
+def shared_array(shape, typecode):
+    """
+    Allocates an array in shared memory. Processes forked after it is 
+    created can write to it without any copying or pickling.
+    """
+    return np.ctypeslib.as_array(RawArray(typecode, int(np.prod(shape)))).reshape(shape)
 
-    return lon[llcloni:urcloni],lat[llclati:urclati],out_raster
+def predict_pixel_range(brt_evaluator, rasters, where_notmask, out, start, stop, chunk=1000000):
+    """
+    Evaluates pixels start:stop of the shared predictor arrays and writes the
+    probabilities into the flattened shared output raster.
+    """
+    flat_out = out.reshape(-1)
+    for i in xrange(start, stop, chunk):
+        j = min(i+chunk, stop)
+        pred_vars = dict([(k, v[i:j]) for k, v in rasters.iteritems()])
+        flat_out[where_notmask[i:j]] = pm.flib.invlogit(brt_evaluator(pred_vars))
+
+@profiled('trees_to_map_parallel', count=lambda r: len(r[0])*len(r[1]), unit='pixels')
+def trees_to_map_parallel(brt_evaluator, species_name, layer_names, glob_name, glob_channels, bbox, n_processes=None):
+    """
+    Like trees_to_map, but the unmasked predictor values, the indices of the
+    unmasked pixels and the output raster are put in shared memory once, and
+    n_processes forked processes each evaluate a disjoint range of pixels. 
+    n_processes defaults to the number of cores.
+    """
+    if n_processes is None:
+        n_processes = multiprocessing.cpu_count()
+    tiles = map_tiles(layer_names, glob_name, glob_channels, bbox, raw_glob=brt_evaluator.raw_glob_name is not None)
+    
+    glob = tiles.glob.rows(tiles.row_start, tiles.row_stop, tiles.cols)
+    notmask = np.flatnonzero(~glob.mask)
+    n = len(notmask)
+    where_notmask = shared_array(n, 'l')
+    where_notmask[:] = notmask
+    del notmask
+    
+    # Fill the shared predictor arrays a tile at a time. Both the tiles and 
+    # np.flatnonzero go through the pixels in row-major order.
+    rasters = dict([(k, shared_array(n, 'f')) for k in tiles.names])
+    offset = 0
+    for start, g, tile_where_notmask, tile_rasters in tiles:
+        m = len(tile_where_notmask[0])
+        for k, v in tile_rasters.iteritems():
+            rasters[k][offset:offset+m] = v
+        offset += m
+        
+    out = shared_array(glob.shape, 'f')
+    out[:] = glob.data
+    
+    bounds = np.linspace(0, n, n_processes+1).astype('int')
+    workers = [multiprocessing.Process(target=predict_pixel_range, args=(brt_evaluator, rasters, where_notmask, out, bounds[i], bounds[i+1])) for i in xrange(n_processes)]
+    [w.start() for w in workers]
+    [w.join() for w in workers]
+    if np.any([w.exitcode != 0 for w in workers]):
+        raise RuntimeError, 'Species %s: some map prediction processes failed.'%species_name
+    
+    return tiles.lon, tiles.lat, np.ma.masked_array(out, mask=glob.mask)
@@ -0,0 +1,201 @@
+# Copyright (C) 2009  Anand Patil
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import fcntl
+import hashlib
+import cPickle
+import numpy as np
+
+__all__ = ['fingerprint', 'cache_lock', 'cache_dir', 'anopheles_cache']
+
+def fingerprint(*parts):
+    """
+    Returns a hex digest that depends on the exact contents of the parts.
+    Arrays contribute their dtype, shape and raw data, strings contribute
+    themselves and anything else contributes its pickle.
+    """
+    h = hashlib.sha1()
+    for p in parts:
+        if isinstance(p, np.ndarray):
+            p = np.ascontiguousarray(p)
+            h.update('array%s%s'%(p.dtype.str, p.shape))
+            h.update(p.tostring())
+        elif isinstance(p, str):
+            h.update('str%i'%len(p))
+            h.update(p)
+        else:
+            s = cPickle.dumps(p, 2)
+            h.update('pickle%i'%len(s))
+            h.update(s)
+    return h.hexdigest()
+
+class cache_lock(object):
+    """
+    An exclusive lock on a single cache key, shared between processes
+    through flock on a lock file.
+    """
+    def __init__(self, fname):
+        self.fname = fname
+        self.f = None
+    def acquire(self, blocking=True):
+        self.f = file(self.fname, 'a')
+        try:
+            fcntl.flock(self.f, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX|fcntl.LOCK_NB)
+        except IOError:
+            self.f.close()
+            self.f = None
+            return False
+        return True
+    def release(self):
+        fcntl.flock(self.f, fcntl.LOCK_UN)
+        self.f.close()
+        self.f = None
+    def __enter__(self):
+        self.acquire()
+        return self
+    def __exit__(self, *exc_info):
+        self.release()
+
+class cache_dir(object):
+    """
+    Manages a directory of cached files, shared between processes.
+
+    - Membership tests cost a single stat rather than a directory listing.
+      An in-memory index of sizes and access times, built once, is used
+      to decide what to evict.
+    - write() writes to a temporary file and renames it into place, so
+      readers never see a half-written file.
+    - lock(key) returns a lock on the key that excludes other processes.
+      Hold it around the whole check-compute-write sequence so that only
+      one process computes each entry.
+    - If max_bytes is set, the least recently used files are evicted after
+      each write until the directory fits. Keys that are locked are skipped.
+      Evicted keys' lock files are removed too, along with any other
+      unheld lock files of keys that are not in the cache.
+    """
+    def __init__(self, dirname, max_bytes=None):
+        self.dirname = dirname
+        self.max_bytes = max_bytes
+        self.index = None
+        self.hits = 0
+        self.misses = 0
+
+    def path(self, key):
+        return os.path.join(self.dirname, key)
+
+    def scan(self):
+        "Rebuilds the index from the directory."
+        for d in [self.dirname, os.path.join(self.dirname, '.locks')]:
+            if not os.path.isdir(d):
+                os.mkdir(d)
+        self.index = {}
+        for key in os.listdir(self.dirname):
+            if key.startswith('.'):
+                continue
+            try:
+                st = os.stat(self.path(key))
+            except OSError:
+                continue
+            self.index[key] = [st.st_size, st.st_mtime]
+
+    def __contains__(self, key):
+        if self.index is None:
+            self.scan()
+        try:
+            # Also marks the key as recently used, for every process. In a
+            # cache shared between users, other users' files may not be ours
+            # to touch, but they are still there.
+            os.utime(self.path(key), None)
+        except OSError:
+            pass
+        try:
+            st = os.stat(self.path(key))
+        except OSError:
+            self.index.pop(key, None)
+            self.misses += 1
+            return False
+        self.index[key] = [st.st_size, st.st_mtime]
+        self.hits += 1
+        return True
+
+    def lock(self, key):
+        if self.index is None:
+            self.scan()
+        return cache_lock(os.path.join(self.dirname, '.locks', key+'.lock'))
+
+    def write(self, key, writer):
+        """
+        Calls writer with the name of a temporary file in the cache
+        directory, then renames the file to key. The temporary name has
+        the same extension as key, for writers that add one.
+        """
+        if self.index is None:
+            self.scan()
+        base, ext = os.path.splitext(key)
+        tmp = os.path.join(self.dirname, '.%s.%i.tmp%s'%(base, os.getpid(), ext))
+        try:
+            writer(tmp)
+            os.rename(tmp, self.path(key))
+        except:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        self.index[key] = [os.path.getsize(self.path(key)), os.path.getmtime(self.path(key))]
+        if self.max_bytes is not None and np.sum([v[0] for v in self.index.itervalues()]) > self.max_bytes:
+            self.evict(keep=key)
+
+    def evict(self, keep=None):
+        "Removes least recently used files until the directory fits in max_bytes."
+        self.scan()
+        total = np.sum([v[0] for v in self.index.itervalues()])
+        for key in sorted(self.index.iterkeys(), key=lambda k: self.index[k][1]):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            l = self.lock(key)
+            if not l.acquire(blocking=False):
+                continue
+            try:
+                os.remove(self.path(key))
+                total -= self.index.pop(key)[0]
+            except OSError:
+                pass
+            self.remove_lock(l)
+
+        lock_dir = os.path.join(self.dirname, '.locks')
+        for lock_fname in os.listdir(lock_dir):
+            key = lock_fname[:-len('.lock')]
+            if key in self.index:
+                continue
+            l = cache_lock(os.path.join(lock_dir, lock_fname))
+            if l.acquire(blocking=False):
+                self.remove_lock(l)
+
+    def remove_lock(self, l):
+        """
+        Deletes the file of a lock this process holds, then releases it.
+        A process already waiting on the old file will find its key
+        missing and compute it, perhaps alongside one that made a new lock
+        file; both write through rename, so the entry is never corrupt.
+        """
+        try:
+            os.remove(l.fname)
+        except OSError:
+            pass
+        l.release()
+
+anopheles_cache = cache_dir('anopheles-caches')
@@ -20,7 +20,7 @@ from __future__ import division
 import numpy as np
 from env_data import extract_environment
 
-__all__ = ['compose','simple_assessments','roc','plot_roc','plot_roc_']
+__all__ = ['compose','simple_assessments','confusion_counts','assessments_at_thresholds','roc','plot_roc','plot_roc_']
 
 def compose(*fns):
     def composite_function(*a, **k):
@@ -59,30 +59,72 @@ def kappa(p, a):
     
 simple_assessments = [proportion_correct, false_positives, false_negatives, sensitivity, specificity, producer_accuracy, consumer_accuracy, kappa]
     
-def roc(ps, a):
+def confusion_counts(p, a):
     """
-    ps is a stack of classification vectors.
+    p is a vector of predicted probabilities. Sorts it once and returns its
+    distinct values in decreasing order, and the numbers of true and false 
+    positives when everything at or above each of them is classified as 
+    present.
     """
+    a = np.asarray(a).astype('bool')
+    order = np.argsort(-np.asarray(p), kind='mergesort')
+    p = np.asarray(p)[order]
+    a = a[order]
+    # Only the last of a run of tied probabilities is a valid threshold.
+    last = np.concatenate((np.flatnonzero(np.diff(p)), [len(p)-1]))
+    return p[last], np.cumsum(a)[last], np.cumsum(~a)[last]
+
+def assessments_at_thresholds(p, a, counts=None):
+    """
+    Computes every simple assessment at every distinct threshold of the
+    predicted probabilities p in one vectorized pass. Returns the thresholds
+    and a dictionary of arrays; producer_accuracy and consumer_accuracy
+    are split into their two components. counts may be the output of
+    confusion_counts(p, a), to avoid sorting p again.
+    """
+    if counts is None:
+        counts = confusion_counts(p, a)
+    t, tp, fp = counts
+    n = float(len(a))
+    pos = np.sum(a)
+    neg = n - pos
+    fn = pos - tp
+    tn = neg - fp
     
-    t = np.linspace(0,1,500)
-    tp = [1]
-    fp = [1]
-    
-    marginal_p = np.sum(ps,axis=0)/ps.shape[0]
-    tot_neg = float(np.sum(True-a))
+    res = {}
+    olderr = np.seterr(divide='ignore', invalid='ignore')
+    res['proportion_correct'] = (tp+tn)/n
+    res['false_positives'] = fp/n
+    res['false_negatives'] = fn/n
+    res['sensitivity'] = res['producer_accuracy_true'] = tp/float(pos)
+    res['specificity'] = res['producer_accuracy_false'] = tn/float(neg)
+    res['consumer_accuracy_true'] = tp/(tp+fp).astype('float')
+    res['consumer_accuracy_false'] = tn/(tn+fn).astype('float')
+    pa = pos/n
+    pp = (tp+fp)/n
+    pagree = pa*pp + (1-pa)*(1-pp)
+    res['kappa'] = (res['proportion_correct']-pagree)/(1-pagree)
+    np.seterr(**olderr)
+    return t, res
+
+def roc(ps, a, counts=None):
+    """
+    ps is a vector of predicted probabilities, or a stack of classification 
+    vectors that is averaged into one. Returns the exact ROC curve, from 
+    (1,1) to (0,0), and its area, using a single sort. counts may be the
+    output of confusion_counts for ps, in which case ps is not sorted at all.
+    """
+    if counts is None:
+        ps = np.asarray(ps)
+        if ps.ndim > 1:
+            ps = np.sum(ps,axis=0)/float(ps.shape[0])
+        counts = confusion_counts(ps, a)
+    t, tp, fp = counts
     tot_pos = float(np.sum(a))
+    tot_neg = float(len(a) - tot_pos)
     
-    for i in xrange(len(t)):
-        p = marginal_p>t[i]
-        fp_here = np.sum((True-a)*p)/tot_neg
-        if fp_here < 1:
-            tp.append(np.sum(p*a)/tot_pos)
-            fp.append(fp_here)
-        if fp_here == 0:
-            break
-            
-    fp = np.array(fp)
-    tp = np.array(tp)
+    fp = np.concatenate(([0], fp/tot_neg))[::-1]
+    tp = np.concatenate(([0], tp/tot_pos))[::-1]
     
     AUC = -np.sum(np.diff(fp)*(tp[1:] + tp[:-1]))/2.    
     return fp, tp, AUC 
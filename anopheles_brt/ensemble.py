@@ -0,0 +1,159 @@
+# Copyright (C) 2009  Anand Patil
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Uncertainty maps from an ensemble of BRTs fitted to resamples of the
+# training table. The members are fitted in parallel by a stage_scheduler, and
+# their maps are summarised a tile at a time, so no member's full map is ever
+# held in memory or written out.
+
+import os
+import numpy as np
+import pymc as pm
+from caching import anopheles_cache, fingerprint
+from brt_wrap import brt, load_training_table, write_training_table, unpack_brt_trees, unpack_gbm_object, brt_evaluator, map_tiles, get_result_dir
+from raster_tiles import map_writer
+from scheduler import stage_scheduler
+from profiling import profiled
+
+__all__ = ['resample_training_table', 'fit_ensemble', 'ensemble_evaluators', 'trees_to_ensemble_maps']
+
+def member_seed(seed, k):
+    "An integer seed for ensemble member k, which depends on seed if it is given."
+    return int(fingerprint(seed, k)[:7], 16)
+
+def resample_training_table(fname, k, resample='bootstrap', seed=None):
+    """
+    Writes the k'th resample of the training table fname to the cache, and
+    returns its name. If resample is 'bootstrap', rows are drawn with
+    replacement. If it is 'pseudoabsences', the presences are kept and
+    the pseudoabsence rows are drawn with replacement.
+    """
+    if resample not in ['bootstrap', 'pseudoabsences']:
+        raise ValueError, 'Unknown resampling method %s; should be bootstrap or pseudoabsences.'%resample
+    resampled_fname = fingerprint(fname, resample, k, seed)+'.hdf5'
+    key_lock = anopheles_cache.lock(resampled_fname)
+    key_lock.acquire()
+    try:
+        if resampled_fname in anopheles_cache:
+            return resampled_fname
+        data = load_training_table(fname)
+        random_state = np.random.RandomState(member_seed(seed, k))
+        if resample == 'bootstrap':
+            rows = random_state.randint(len(data), size=len(data))
+        else:
+            presences = np.flatnonzero(data.found)
+            absences = np.flatnonzero(data.found==0)
+            rows = np.concatenate((presences, absences[random_state.randint(len(absences), size=len(absences))]))
+        anopheles_cache.write(resampled_fname, lambda f: write_training_table(data[rows], f))
+        return resampled_fname
+    finally:
+        key_lock.release()
+
+def fit_member(fname, species_name, gbm_opts, k, resample, seed):
+    "Fits ensemble member k, with its own seed for the folds and bags, whichever the backend."
+    resampled_fname = resample_training_table(fname, k, resample, seed)
+    gbm_opts = dict(gbm_opts)
+    gbm_opts['seed'] = member_seed(seed, k)
+    return brt(resampled_fname, species_name, gbm_opts)
+
+@profiled('fit_ensemble', count=len, unit='models')
+def fit_ensemble(fname, species_name, gbm_opts, n_models, resample='bootstrap', n_processes=1, seed=None):
+    """
+    Fits n_models BRTs with brt, each to a resample of the training table
+    fname made by resample_training_table, in up to n_processes processes.
+    Members whose fits fail, for instance because gbm.step does not
+    converge on their resample, are reported and left out. Returns the
+    other members' results, in order.
+    """
+    sched = stage_scheduler(n_processes if n_processes > 1 else 0)
+    for k in xrange(n_models):
+        sched.add(k, fit_member, args=[fname, species_name, gbm_opts, k, resample, seed])
+    sched.run()
+    if len(sched.results) == 0:
+        raise ValueError, 'Every member of the ensemble for species %s failed.'%species_name
+    if sched.errors:
+        print 'Species %s: %i of %i ensemble members failed and were left out.'%(species_name, len(sched.errors), n_models)
+    return [sched.results[k] for k in xrange(n_models) if k in sched.results]
+
+def ensemble_evaluators(brt_results, layer_names, glob_name, glob_channels):
+    "Returns a compiled brt_evaluator for each member of an ensemble."
+    out = []
+    for res in brt_results:
+        nice_tree_dict = unpack_brt_trees(res, layer_names, glob_name, glob_channels)
+        intercept = unpack_gbm_object(res, 'initF')[0][0]
+        out.append(brt_evaluator(nice_tree_dict, intercept, compiled=True, glob_name=glob_name, glob_channels=glob_channels))
+    return out
+
+def quantile_rows(sorted_values, q):
+    "The q'th quantile of each column of sorted_values, interpolating linearly between order statistics."
+    pos = q*(len(sorted_values)-1)
+    lo = int(np.floor(pos))
+    hi = min(lo+1, len(sorted_values)-1)
+    return sorted_values[lo] + (pos-lo)*(sorted_values[hi]-sorted_values[lo])
+
+@profiled('trees_to_ensemble_maps', count=lambda r: len(r[0])*len(r[1]), unit='pixels')
+def trees_to_ensemble_maps(brt_evaluators, species_name, layer_names, glob_name, glob_channels, bbox, quantiles=(.025, .5, .975), tile_rows=64, map_format='flt'):
+    """
+    Makes maps of the mean and standard deviation of the probabilities
+    predicted by a list of evaluators, and of the requested quantiles, in
+    a single pass over the rasters. They are written to the results
+    directory as probability-mean.flt, probability-sd.flt and, for example,
+    probability-q0.025.flt, or as .h5 files if map_format is 'h5'.
+
+    The mean and standard deviation are accumulated one member at a time.
+    The quantiles need every member's predictions for a tile at once, in
+    single precision, so memory grows with tile_rows times the number of
+    members. Returns the lon and lat vectors and a dictionary of filenames.
+    """
+    raw_glob = np.all([be.raw_glob_name is not None for be in brt_evaluators])
+    tiles = map_tiles(layer_names, glob_name, glob_channels, bbox, tile_rows, raw_glob)
+    pred_names = [be.raw_glob_names if raw_glob else set(be.nice_tree_dict.keys()) for be in brt_evaluators]
+    for names in pred_names:
+        if not names <= set(tiles.names):
+            raise ValueError, 'The ensemble uses predictors that are not among the requested layers and channels.'
+
+    result_dirname = get_result_dir(species_name)
+    stat_names = ['mean', 'sd'] + ['q%g'%q for q in quantiles]
+    outs = dict([(n, map_writer(os.path.join(result_dirname, 'probability-%s.flt'%n), tiles.lon, tiles.lat, map_format)) for n in stat_names])
+
+    n_models = len(brt_evaluators)
+    for start, glob, where_notmask, rasters in tiles:
+        n_pixels = len(where_notmask[0])
+        mean = np.zeros(n_pixels)
+        sum_sq = np.zeros(n_pixels)
+        if quantiles:
+            stack = np.empty((n_models, n_pixels), dtype='float32')
+        if n_pixels > 0:
+            for k, be in enumerate(brt_evaluators):
+                p = pm.flib.invlogit(be(dict([(n, rasters[n]) for n in pred_names[k]])))
+                # Welford's update of the mean and the sum of squared deviations.
+                delta = p - mean
+                mean += delta/(k+1)
+                sum_sq += delta*(p-mean)
+                if quantiles:
+                    stack[k] = p
+        stats = {'mean': mean, 'sd': np.sqrt(sum_sq/(n_models-1)) if n_models > 1 else sum_sq}
+        if quantiles:
+            stack.sort(axis=0)
+            for q in quantiles:
+                stats['q%g'%q] = quantile_rows(stack, q)
+
+        for n in stat_names:
+            out_tile = glob.astype('float32')
+            out_tile[where_notmask] = stats[n]
+            outs[n].write_rows(start, out_tile)
+
+    [out.close() for out in outs.itervalues()]
+    return tiles.lon, tiles.lat, dict([(n, out.fname) for n, out in outs.iteritems()])
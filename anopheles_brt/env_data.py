@@ -14,35 +14,87 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
-import map_utils
-import hashlib
 import numpy
+from caching import anopheles_cache, fingerprint
+from raster_tiles import windowed_raster, point_indices
+from profiling import profiled
 
-__all__ = ['extract_environment']
+__all__ = ['extract_environment', 'check_grid', 'extract_points', 'extract_environment_batch']
 
+@profiled('extract_environment', count=lambda r: len(r[1]))
 def extract_environment(layer_name, x, postproc=lambda x:x, id_=None, lock=None):
     "Expects ALL locations to be in decimal degrees."
     
-    fname = hashlib.sha1(x.tostring()+layer_name+str(id_)).hexdigest()+'.npy'
+    fname = fingerprint(x, layer_name, str(id_))+'.npy'
     path, name = os.path.split(layer_name)
     name = os.path.splitext(name)[0]
-    if fname in os.listdir('anopheles-caches'):
-        return name, numpy.load(os.path.join('anopheles-caches',fname))
-    else:    
+    key_lock = anopheles_cache.lock(fname)
+    key_lock.acquire()
+    try:
+        if fname in anopheles_cache:
+            return name, numpy.load(anopheles_cache.path(fname))
         
-        # if lock is not None:
-        #     lock.acquire()
-        grid_lon, grid_lat, grid_data, grid_type = map_utils.import_raster(name,path)
+        grid = windowed_raster(layer_name)
+        rows, cols, outside = point_indices(grid.lon, grid.lat, x)
         
-        # Convert to centroids
-        grid_lon += (grid_lon[1]-grid_lon[0])/2.
-        grid_lat += (grid_lat[1]-grid_lat[0])/2.
-        
-        # Interpolate
-        extracted = map_utils.interp_geodata(grid_lon, grid_lat, postproc(grid_data).data, x[:,0], x[:,1], grid_data.mask, chunk=None, view='y-x+', order=0)
-        del grid_data
-        # if lock is not None:
-        #     lock.release()
+        # Nearest-neighbour extraction; postproc is applied to the extracted values.
+        values = grid.pixels(rows, cols)
+        extracted = numpy.ma.filled(numpy.ma.masked_array(postproc(values.data), mask=values.mask).astype('float'), numpy.nan)
+        extracted[outside] = numpy.nan
 
-        numpy.save(os.path.join('anopheles-caches',fname), extracted)
+        anopheles_cache.write(fname, lambda f: numpy.save(f, extracted))
         return name, extracted
+    finally:
+        key_lock.release()
+
+def check_grid(layer_names, glob_name, rasters):
+    "Raises a ValueError unless the windowed_rasters of layer_names are on the same grid as the glob raster, which comes last."
+    for ln, r in zip(layer_names, rasters):
+        if r.shape != rasters[-1].shape or r.lon[0] != rasters[-1].lon[0] or r.lat[0] != rasters[-1].lat[0]:
+            raise ValueError, 'Raster %s is not on the same grid as glob raster %s.'%(ln, glob_name)
+
+def extract_points(rasters, x):
+    """
+    Takes windowed_rasters on a common grid and returns their values at the
+    points x, one row per raster, with NaN where a point is masked or off
+    the grid. Expects ALL locations to be in decimal degrees.
+    """
+    rows, cols, outside = point_indices(rasters[-1].lon, rasters[-1].lat, x)
+    values = numpy.empty((len(rasters), len(x)))
+    for i, r in enumerate(rasters):
+        values[i] = numpy.ma.filled(r.pixels(rows, cols).astype('float'), numpy.nan)
+    values[:,outside] = numpy.nan
+    return values
+
+@profiled('extract_environment_batch', count=lambda r: len(r[1]))
+def extract_environment_batch(layer_names, glob_name, glob_channels, x):
+    """
+    Extracts every layer and glob channel at the points x in one pass.
+    All the rasters must share a grid, so the pixel indices of the points
+    are only computed once. Only the pixels that are needed are read from
+    rasters that can be memory-mapped. The glob raster is extracted once 
+    and the channel indicators are made from its class codes.
+    
+    Returns a list of (name, values) tuples, layers first and then glob 
+    channels, and a boolean array that is True for points where any of the 
+    values is NaN. Expects ALL locations to be in decimal degrees.
+    """
+    names = [os.path.splitext(os.path.basename(ln))[0] for ln in layer_names]\
+            + [os.path.basename(glob_name)+'_'+str(ch) for ch in glob_channels]
+    fname = fingerprint(x, list(layer_names), glob_name, list(glob_channels))+'.npy'
+    key_lock = anopheles_cache.lock(fname)
+    key_lock.acquire()
+    try:
+        if fname in anopheles_cache:
+            extracted = numpy.load(anopheles_cache.path(fname))
+        else:
+            rasters = map(windowed_raster, list(layer_names) + [glob_name])
+            check_grid(layer_names, glob_name, rasters)
+            values = extract_points(rasters, x)
+            glob_codes = values[-1]
+            extracted = numpy.vstack([values[:-1]] + [numpy.where(numpy.isnan(glob_codes), numpy.nan, glob_codes==ch) for ch in glob_channels])
+            anopheles_cache.write(fname, lambda f: numpy.save(f, extracted))
+    finally:
+        key_lock.release()
+    
+    return zip(names, extracted), numpy.any(numpy.isnan(extracted), axis=0)
@@ -0,0 +1,563 @@
+# Copyright (C) 2009  Anand Patil
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# A NumPy implementation of Leathwick and Elith's gbm.step, from
+# brt.functions.R, for Bernoulli boosted stumps. The procedure is the same:
+# n.folds cross-validation models are grown step.size trees at a time until
+# the mean hold-out deviance stops improving, and then a final model is fit
+# to all the data with the number of trees that minimised it. Each tree is
+# fit as gbm does for the Bernoulli family: the split maximises the
+# reduction in squared error of the residuals y-p on a bag of the data, and
+# the node values are Newton steps scaled by the learning rate.
+#
+# Splits are found on histograms of pre-binned predictors. Split points lie
+# halfway between adjacent bins, as gbm places them halfway between adjacent
+# observed values.
+
+import numpy as np
+import multiprocessing
+
+__all__ = ['r_literal', 'bin_predictors', 'bernoulli_deviance', 'stump_booster', 'serial_folds', 'parallel_folds', 'cross_validate', 'numpy_gbm_result', 'stump_opts', 'gbm_step', 'gbm_simplify']
+
+def r_literal(v):
+    "Converts a brt_opts value, which may be written as R code, to Python."
+    if isinstance(v, str):
+        v = v.strip().strip('"\'')
+        if v in ['TRUE','T']:
+            return True
+        if v in ['FALSE','F']:
+            return False
+        try:
+            return float(v)
+        except ValueError:
+            return v
+    return v
+
+def bin_predictors(x, n_bins=256):
+    """
+    Takes an (n,p) array of predictors. Returns an (n,p) array of bin codes,
+    with at most n_bins bins of roughly equal counts per predictor and tied
+    values always in the same bin, and a (p, n_bins-1) array of split points.
+    An observation is left of split k of predictor j if its code is at most k.
+    """
+    n, p = x.shape
+    codes = np.empty((n,p), dtype='int')
+    splits = np.empty((p, n_bins-1))
+    splits.fill(np.inf)
+    for j in xrange(p):
+        v = x[:,j]
+        uniq = np.unique(v)
+        if len(uniq) <= n_bins:
+            upper = uniq
+        else:
+            upper = np.unique(np.sort(v)[np.linspace(0, n-1, n_bins+1)[1:].astype('int')])
+        codes[:,j] = np.searchsorted(upper, v)
+        # Halfway between the top of each bin and the bottom of the next.
+        above = uniq[np.searchsorted(uniq, upper[:-1])+1]
+        splits[j,:len(upper)-1] = (upper[:-1] + above)/2.
+    return codes, splits
+
+def bernoulli_deviance(y, f, w, mean=True):
+    "calc.deviance for the Bernoulli family, from the linear predictor f."
+    dev = -2*np.sum(w*(y*f - np.logaddexp(0, f)))
+    if mean:
+        dev /= len(y)
+    return dev
+
+class stump_booster(object):
+    """
+    A Bernoulli boosted stump model fit to the observations train, which
+    keeps its linear predictor up to date on the observations hold as well.
+    Trees are stored as arrays of predictor index, split bin, split point,
+    left and right values and error reduction. Only the predictors marked
+    in active are split on.
+    """
+    def __init__(self, codes, splits, y, w, train, hold, learning_rate, bag_fraction, seed=None, min_obs=10):
+        self.codes = codes
+        self.splits = splits
+        self.y = y
+        self.w = w
+        self.train = train
+        self.hold = hold
+        self.learning_rate = learning_rate
+        self.n_bag = int(np.floor(bag_fraction*len(train)))
+        self.min_obs = min_obs
+        self.random_state = np.random.RandomState(seed)
+        self.active = np.ones(codes.shape[1], dtype='bool')
+
+        n_bins = splits.shape[1]+1
+        self.offset_codes = codes[train] + np.arange(codes.shape[1])*n_bins
+        self.initF = np.log(np.sum(w[train]*y[train])/np.sum(w[train]*(1-y[train])))
+        self.f_train = np.empty(len(train))
+        self.f_train.fill(self.initF)
+        self.f_hold = np.empty(len(hold))
+        self.f_hold.fill(self.initF)
+        self.trees = []
+
+    def grow(self, n_trees):
+        p = self.codes.shape[1]
+        n_bins = self.splits.shape[1]+1
+        y = self.y[self.train]
+        w = self.w[self.train]
+        for t in xrange(n_trees):
+            prob = 1./(1.+np.exp(-self.f_train))
+            z = y - prob
+            bag = self.random_state.permutation(len(self.train))[:self.n_bag]
+
+            # Histograms of the residuals, weights and counts for every predictor at once.
+            flat = self.offset_codes[bag].ravel()
+            S = np.bincount(flat, weights=np.repeat(w[bag]*z[bag], p), minlength=p*n_bins).reshape((p,n_bins))
+            W = np.bincount(flat, weights=np.repeat(w[bag], p), minlength=p*n_bins).reshape((p,n_bins))
+            N = np.bincount(flat, minlength=p*n_bins).reshape((p,n_bins))
+
+            SL = np.cumsum(S,axis=1)[:,:-1]
+            WL = np.cumsum(W,axis=1)[:,:-1]
+            NL = np.cumsum(N,axis=1)[:,:-1]
+            SR = S.sum(axis=1)[:,None] - SL
+            WR = W.sum(axis=1)[:,None] - WL
+            NR = len(bag) - NL
+            valid = (NL>=self.min_obs) & (NR>=self.min_obs) & (WL>0) & (WR>0)
+            olderr = np.seterr(divide='ignore', invalid='ignore')
+            improvement = np.where(valid, (SL/WL - SR/WR)**2*WL*WR/(WL+WR), -1)
+            np.seterr(**olderr)
+            improvement[~self.active] = -1
+
+            best = np.argmax(improvement)
+            j, k = best // (n_bins-1), best % (n_bins-1)
+            if improvement[j,k] < 0:
+                # No admissible split; the tree does nothing.
+                self.trees.append((0, 0, self.splits[0,0], 0., 0., 0.))
+                continue
+
+            # Newton steps in each node, over the bag.
+            left = self.codes[self.train[bag], j] <= k
+            h = w[bag]*prob[bag]*(1-prob[bag])
+            left_val = self.learning_rate*SL[j,k]/np.sum(h[left])
+            right_val = self.learning_rate*SR[j,k]/np.sum(h[~left])
+
+            self.f_train += np.where(self.codes[self.train,j] <= k, left_val, right_val)
+            self.f_hold += np.where(self.codes[self.hold,j] <= k, left_val, right_val)
+            self.trees.append((j, k, self.splits[j,k], left_val, right_val, improvement[j,k]))
+
+    def losses(self):
+        "Returns the mean hold-out and training deviances."
+        return (bernoulli_deviance(self.y[self.hold], self.f_hold, self.w[self.hold]),
+                bernoulli_deviance(self.y[self.train], self.f_train, self.w[self.train]))
+
+    def influence(self):
+        "Returns the total error reduction due to each predictor."
+        influence = np.zeros(len(self.active))
+        for t in self.trees:
+            influence[t[0]] += t[5]
+        return influence
+
+    def weakest(self):
+        "Returns the index of the active predictor with the least influence."
+        active = np.flatnonzero(self.active)
+        influence = self.influence()[active]
+        # The last of the ties, as at the bottom of gbm.step's contributions table.
+        return active[len(active)-1-np.argmin(influence[::-1])]
+
+    def drop_predictor(self, j, n_trees):
+        """
+        Removes predictor j from the model. Because the trees are stumps,
+        the trees that split on other predictors still make up a model;
+        they are kept, and the model is grown back to n_trees trees.
+        """
+        self.active[j] = False
+        self.trees = [t for t in self.trees if t[0] != j]
+        self.f_train = self.predict_codes(self.train)
+        self.f_hold = self.predict_codes(self.hold)
+        self.grow(n_trees - len(self.trees))
+
+    def tree_arrays(self, n_trees=None):
+        "Returns the first n_trees trees as a record array."
+        trees = self.trees[:n_trees]
+        return np.rec.fromrecords(trees, names='predictor,bin,split_loc,left_val,right_val,improvement')
+
+    def predict_codes(self, rows, n_trees=None):
+        "Returns the linear predictor at the given rows of codes, using the first n_trees trees."
+        f = np.empty(len(rows))
+        f.fill(self.initF)
+        for j, k, s, l, r, i in self.trees[:n_trees]:
+            f += np.where(self.codes[rows,j] <= k, l, r)
+        return f
+
+class serial_folds(object):
+    """
+    Advances the cross-validation fold models one after the other, in this
+    process.
+    """
+    def __init__(self, folds):
+        self.folds = folds
+    def grow(self, n_trees):
+        "Grows every fold model by n_trees trees and returns their hold-out and training deviances."
+        for m in self.folds:
+            m.grow(n_trees)
+        return [m.losses() for m in self.folds]
+    def predict_hold(self, n_trees):
+        "Returns each fold model's linear predictor on its hold-out set using its first n_trees trees."
+        return [m.predict_codes(m.hold, n_trees) for m in self.folds]
+    def drop_weakest(self, n_trees):
+        """
+        Drops each fold model's weakest predictor and grows it back to
+        n_trees trees. Returns the dropped predictors and the new hold-out
+        deviances.
+        """
+        out = []
+        for m in self.folds:
+            j = m.weakest()
+            m.drop_predictor(j, n_trees)
+            out.append((j, m.losses()[0]))
+        return out
+    def close(self):
+        pass
+
+def fold_worker(conn, folds):
+    "Runs in a child process, holding some fold models and advancing them on request."
+    local = serial_folds(folds)
+    while True:
+        msg = conn.recv()
+        if msg is None:
+            break
+        method, args = msg
+        conn.send(getattr(local, method)(*args))
+    conn.close()
+
+class parallel_folds(serial_folds):
+    """
+    Keeps the cross-validation fold models in n_processes worker processes
+    for their whole lives and advances them all at once. Each fold model
+    draws its bags from its own seed, so the results are identical to
+    serial_folds'. The predictor codes are inherited by the workers when
+    they are forked, not copied through the pipes.
+    """
+    def __init__(self, folds, n_processes):
+        n_processes = min(n_processes, len(folds))
+        self.order = np.argsort(np.concatenate([np.arange(len(folds))[i::n_processes] for i in xrange(n_processes)]))
+        self.conns = []
+        self.processes = []
+        for i in xrange(n_processes):
+            conn, child_conn = multiprocessing.Pipe()
+            p = multiprocessing.Process(target=fold_worker, args=(child_conn, folds[i::n_processes]))
+            p.start()
+            self.conns.append(conn)
+            self.processes.append(p)
+    def call(self, method, *args):
+        for conn in self.conns:
+            conn.send((method, args))
+        out = []
+        for conn in self.conns:
+            out.extend(conn.recv())
+        return [out[i] for i in self.order]
+    def grow(self, n_trees):
+        return self.call('grow', n_trees)
+    def predict_hold(self, n_trees):
+        return self.call('predict_hold', n_trees)
+    def drop_weakest(self, n_trees):
+        return self.call('drop_weakest', n_trees)
+    def close(self):
+        for conn in self.conns:
+            conn.send(None)
+        for p in self.processes:
+            p.join()
+
+class numpy_gbm_result(object):
+    """
+    Holds the results of gbm_step under the names of the elements of the
+    gbm.object returned by R's gbm.step, so that unpack_gbm_object,
+    print_gbm_object and unpack_brt_trees work on it as they do on the R
+    object. Element 'trees' is laid out as in gbm: one list of SplitVar,
+    SplitCodePred, LeftNode, RightNode, MissingNode, ErrorReduction, Weight
+    and Prediction vectors per tree, with nodes split, left, right and missing.
+    The attribute stumps holds the same trees as a record array, which
+    unpack_brt_trees uses directly.
+
+    r_server.fit_gbm_step also returns R's gbm.objects in this form, with
+    stumps None and with printed mapping element names to R's printout of
+    them, which print_gbm_object prefers.
+    """
+    def __init__(self, elements, stumps=None, printed=None):
+        self.names = [e[0] for e in elements]
+        self.values = [e[1] for e in elements]
+        self.stumps = stumps
+        self.printed = printed or {}
+    def __getitem__(self, i):
+        return self.values[i]
+    def __len__(self):
+        return len(self.values)
+    def __str__(self):
+        return '\n'.join(['$%s\n%s'%(n, v) for n, v in zip(self.names, self.values) if n != 'trees'])
+
+def gbm_tree_layout(trees, w_total):
+    "Converts the output of stump_booster.tree_arrays to gbm's tree layout."
+    out = []
+    for t in trees:
+        out.append([np.array([t.predictor,-1,-1,-1]), np.array([t.split_loc, t.left_val, t.right_val, 0.]),
+                    np.array([1,-1,-1,-1]), np.array([2,-1,-1,-1]), np.array([3,-1,-1,-1]),
+                    np.array([t.improvement,0,0,0]), np.array([w_total,0,0,0]), np.array([0., t.left_val, t.right_val, 0.])])
+    return out
+
+def fold_selector(y, n_folds, prev_stratify, random_state):
+    "Assigns observations to folds as gbm.step does, optionally stratifying by prevalence."
+    selector = np.empty(len(y), dtype='int')
+    groups = [y==1, y!=1] if prev_stratify else [np.ones(len(y), dtype='bool')]
+    for g in groups:
+        n = np.sum(g)
+        selector[g] = (np.arange(n) % n_folds)[random_state.permutation(n)]
+    return selector
+
+def cross_validate(folds, n_trees, step_size, max_trees, tolerance_test, verbose=False):
+    """
+    Grows the fold models as gbm.step does: n_trees trees to start with,
+    then step_size at a time until the mean hold-out deviance stops
+    improving by tolerance_test or max_trees is reached. Returns the
+    hold-out and training deviance matrices (folds by steps), the numbers
+    of trees fitted and the mean hold-out deviances.
+    """
+    cv_loss_matrix = []
+    training_loss_matrix = []
+    trees_fitted = []
+    cv_loss_values = []
+
+    delta_deviance = 1
+    while not trees_fitted or (delta_deviance > tolerance_test and trees_fitted[-1] < max_trees):
+        if trees_fitted:
+            losses = folds.grow(step_size)
+            trees_fitted.append(trees_fitted[-1]+step_size)
+        else:
+            losses = folds.grow(n_trees)
+            trees_fitted.append(n_trees)
+        cv, train = zip(*losses)
+        cv_loss_matrix.append(cv)
+        training_loss_matrix.append(train)
+        cv_loss_values.append(np.mean(cv))
+        j = len(cv_loss_values)
+        if 1 < j < 5 and cv_loss_values[-1] > cv_loss_values[-2]:
+            raise ValueError, 'Hold-out deviance increased; restart model with a smaller learning rate or smaller step size.'
+        if j >= 20:
+            delta_deviance = np.mean(cv_loss_values[j-20:j-9]) - np.mean(cv_loss_values[j-10:j])
+        if verbose:
+            print '%i %f'%(trees_fitted[-1], cv_loss_values[-1])
+
+    return np.array(cv_loss_matrix).T, np.array(training_loss_matrix).T, trees_fitted, cv_loss_values
+
+def stump_opts(brt_opts):
+    "Converts brt_opts to Python values, checking that they ask for stumps."
+    opts = dict([(k, r_literal(v)) for k, v in brt_opts.iteritems()])
+    if opts.get('tree.complexity', 1) != 1:
+        raise ValueError, 'The NumPy backend only fits stumps, so tree.complexity must be 1.'
+    return opts
+
+def gbm_step(data, brt_opts, seed=None, verbose=False):
+    """
+    Fits a Bernoulli boosted stump model to a training table as gbm.step
+    does. data is a record array whose first column is the response and
+    whose other columns are the predictors. The gbm.step options
+    tree.complexity, learning.rate, bag.fraction, n.folds, prev.stratify,
+    n.trees, step.size, max.trees, tolerance.method, tolerance and
+    site.weights are read from brt_opts; the rest are ignored. Returns a
+    numpy_gbm_result.
+
+    If brt_opts['fold.processes'] is greater than 1, the fold models are
+    kept in that many worker processes and advanced in parallel, with
+    the same results. Only this backend does so; brt does not pass the
+    option on to R, whose folds stay serial.
+    """
+    from diagnostics import roc
+
+    opts = stump_opts(brt_opts)
+    learning_rate = opts.get('learning.rate', 0.01)
+    bag_fraction = opts.get('bag.fraction', 0.75)
+    n_folds = int(opts.get('n.folds', 10))
+    prev_stratify = opts.get('prev.stratify', True)
+    n_trees = int(opts.get('n.trees', 50))
+    step_size = int(opts.get('step.size', n_trees))
+    max_trees = int(opts.get('max.trees', 10000))
+    tolerance_method = opts.get('tolerance.method', 'auto')
+    tolerance = opts.get('tolerance', 0.001)
+    fold_processes = int(opts.get('fold.processes', 1))
+
+    names = data.dtype.names
+    y = np.asarray(data[names[0]], dtype='float')
+    x = np.array([data[n] for n in names[1:]], dtype='float').T
+    w = np.asarray(opts.get('site.weights', np.ones(len(y))), dtype='float')
+
+    random_state = np.random.RandomState(seed)
+    fold_seeds = random_state.randint(2**31-1, size=n_folds+1)
+    selector = fold_selector(y, n_folds, prev_stratify, random_state)
+    codes, splits = bin_predictors(x)
+
+    total_deviance = bernoulli_deviance(y, np.log(np.sum(w*y)/np.sum(w*(1-y))), w, mean=False)
+    mean_total_deviance = total_deviance/len(y)
+    if tolerance_method == 'auto':
+        tolerance_test = mean_total_deviance*tolerance
+    elif tolerance_method == 'fixed':
+        tolerance_test = tolerance
+    else:
+        raise ValueError, 'Invalid tolerance.method %s; should be auto or fixed.'%tolerance_method
+
+    folds = [stump_booster(codes, splits, y, w, np.flatnonzero(selector!=i), np.flatnonzero(selector==i),
+                learning_rate, bag_fraction, fold_seeds[i]) for i in xrange(n_folds)]
+    holds = [m.hold for m in folds]
+    if fold_processes > 1:
+        folds = parallel_folds(folds, fold_processes)
+    else:
+        folds = serial_folds(folds)
+    try:
+        cv_loss_matrix, training_loss_matrix, trees_fitted, cv_loss_values = cross_validate(folds, n_trees, step_size, max_trees, tolerance_test, verbose)
+        target_trees = trees_fitted[np.argmin(cv_loss_values)]
+        hold_predictions = folds.predict_hold(target_trees)
+    finally:
+        folds.close()
+
+    # Cross-validation statistics at the optimal number of trees
+    cv_deviance = []
+    cv_roc = []
+    for hold, f in zip(holds, hold_predictions):
+        cv_deviance.append(bernoulli_deviance(y[hold], f, w[hold]))
+        cv_roc.append(roc(1./(1.+np.exp(-f)), y[hold])[2])
+
+    final = stump_booster(codes, splits, y, w, np.arange(len(y)), np.arange(0), learning_rate, bag_fraction, fold_seeds[-1])
+    final.grow(target_trees)
+    trees = final.tree_arrays()
+    fit = final.f_train
+    fitted = 1./(1.+np.exp(-fit))
+    resid_deviance = bernoulli_deviance(y, fit, w, mean=False)
+
+    influence = np.array([np.sum(trees.improvement[trees.predictor==j]) for j in xrange(x.shape[1])])
+    influence = 100*influence/np.sum(influence)
+    order = np.argsort(-influence)
+    contributions = np.rec.fromarrays([np.array(names[1:])[order], influence[order]], names='variable,rel_inf')
+
+    gbm_call = {'predictor.names': list(names[1:]), 'response.name': names[0], 'family': 'bernoulli',
+        'tree.complexity': 1, 'learning.rate': learning_rate, 'bag.fraction': bag_fraction, 'cv.folds': n_folds,
+        'prev.stratification': prev_stratify, 'max.fitted': trees_fitted[-1], 'n.trees': target_trees,
+        'best.trees': target_trees, 'tolerance.method': tolerance_method, 'tolerance': tolerance, 'backend': 'numpy'}
+    self_statistics = {'null': total_deviance, 'mean.null': mean_total_deviance, 'resid': resid_deviance,
+        'mean.resid': resid_deviance/len(y), 'correlation': np.corrcoef(y, fitted)[0,1], 'discrimination': roc(fitted, y)[2]}
+    cv_statistics = {'deviance.mean': np.mean(cv_deviance), 'deviance.se': np.std(cv_deviance, ddof=1)/np.sqrt(n_folds),
+        'discrimination.mean': np.mean(cv_roc), 'discrimination.se': np.std(cv_roc, ddof=1)/np.sqrt(n_folds)}
+
+    return numpy_gbm_result([('initF', np.array([final.initF])),
+                            ('fit', fit),
+                            ('trees', gbm_tree_layout(trees, np.sum(w))),
+                            ('n.trees', np.array([target_trees])),
+                            ('var.names', list(names[1:])),
+                            ('gbm.call', gbm_call),
+                            ('fitted', fitted),
+                            ('contributions', contributions),
+                            ('self.statistics', self_statistics),
+                            ('cv.statistics', cv_statistics),
+                            ('trees.fitted', np.array(trees_fitted)),
+                            ('training.loss.values', np.mean(training_loss_matrix, axis=0)),
+                            ('cv.values', np.array(cv_loss_values)),
+                            ('cv.loss.ses', np.std(cv_loss_matrix, axis=0, ddof=1)/np.sqrt(n_folds)),
+                            ('cv.loss.matrix', cv_loss_matrix),
+                            ('cv.roc.matrix', np.array(cv_roc))], stumps=trees)
+
+def gbm_simplify(data, brt_opts, n_trees, deviance_se, n_drops='auto', alpha=1, seed=None, n_processes=1):
+    """
+    Backward elimination of predictors, as gbm.simplify does. Fold models
+    with n_trees trees are fit to data, then their weakest predictors are
+    dropped one at a time and the change in hold-out deviance recorded.
+    With n_drops='auto', dropping continues until the mean change exceeds
+    alpha times deviance_se, the standard error of the original model's
+    cross-validated deviance. The same sequence of drops is then made on
+    a model fit to all the data.
+
+    Rather than being refit from scratch, a model that loses a predictor
+    keeps its stumps on the other predictors and is grown back to n_trees
+    trees. If n_processes is greater than 1, the folds' elimination
+    sequences run in that many worker processes.
+
+    brt_opts is read as by gbm_step. Returns a dictionary with keys:
+      deviance.summary: mean and se of the change in deviance after each drop
+      deviance.matrix: the changes in deviance, drops by folds
+      drop.count: the step at which each fold dropped each predictor, or 0
+      final.drops: the predictors in the order they were dropped from the full model
+      n.drops: the number of those drops that kept the mean change within alpha*deviance_se
+    """
+    opts = stump_opts(brt_opts)
+    learning_rate = opts.get('learning.rate', 0.01)
+    bag_fraction = opts.get('bag.fraction', 0.75)
+    n_folds = int(opts.get('n.folds', 10))
+    prev_stratify = opts.get('prev.stratify', True)
+
+    names = data.dtype.names
+    y = np.asarray(data[names[0]], dtype='float')
+    x = np.array([data[n] for n in names[1:]], dtype='float').T
+    w = np.asarray(opts.get('site.weights', np.ones(len(y))), dtype='float')
+    max_drops = x.shape[1] - 2
+    auto_stop = n_drops == 'auto'
+    if not auto_stop:
+        n_drops = min(int(n_drops), max_drops)
+    if max_drops <= 0 or (not auto_stop and n_drops <= 0):
+        # Nothing may be dropped, so nothing is fitted.
+        return {'deviance.summary': np.rec.fromarrays([np.zeros(0), np.zeros(0)], names='mean,se'),
+                'deviance.matrix': np.zeros((0, n_folds)),
+                'drop.count': np.rec.fromarrays([np.array(names[1:])] + [np.zeros(x.shape[1], dtype='int')]*n_folds, names=['predictor']+['rep.%i'%(i+1) for i in xrange(n_folds)]),
+                'final.drops': [],
+                'n.drops': 0}
+
+    random_state = np.random.RandomState(seed)
+    fold_seeds = random_state.randint(2**31-1, size=n_folds+1)
+    selector = fold_selector(y, n_folds, prev_stratify, random_state)
+    codes, splits = bin_predictors(x)
+
+    folds = [stump_booster(codes, splits, y, w, np.flatnonzero(selector!=i), np.flatnonzero(selector==i),
+                learning_rate, bag_fraction, fold_seeds[i]) for i in xrange(n_folds)]
+    if n_processes > 1:
+        folds = parallel_folds(folds, n_processes)
+    else:
+        folds = serial_folds(folds)
+
+    dev_results = []
+    drop_count = np.zeros((x.shape[1], n_folds), dtype='int')
+    try:
+        original_deviances = np.array([l[0] for l in folds.grow(n_trees)])
+        while len(dev_results) < max_drops:
+            dropped, deviances = zip(*folds.drop_weakest(n_trees))
+            dev_results.append(np.array(deviances) - original_deviances)
+            drop_count[np.array(dropped), np.arange(n_folds)] = len(dev_results)
+            if auto_stop:
+                if np.mean(dev_results[-1]) >= alpha*deviance_se:
+                    break
+            elif len(dev_results) == n_drops:
+                break
+    finally:
+        folds.close()
+
+    dev_results = np.array(dev_results)
+    mean_delta = dev_results.mean(axis=1)
+    se_delta = dev_results.std(axis=1, ddof=1)/np.sqrt(n_folds)
+
+    # The final sequence of drops, on all the data
+    final = stump_booster(codes, splits, y, w, np.arange(len(y)), np.arange(0), learning_rate, bag_fraction, fold_seeds[-1])
+    final.grow(n_trees)
+    final_drops = []
+    for i in xrange(len(dev_results)):
+        j = final.weakest()
+        final_drops.append(names[1:][j])
+        final.drop_predictor(j, n_trees)
+
+    within = mean_delta < alpha*deviance_se
+    recommended = len(within) if np.all(within) else np.argmin(within)
+
+    return {'deviance.summary': np.rec.fromarrays([mean_delta, se_delta], names='mean,se'),
+            'deviance.matrix': dev_results,
+            'drop.count': np.rec.fromarrays([np.array(names[1:])] + list(drop_count.T), names=['predictor']+['rep.%i'%(i+1) for i in xrange(n_folds)]),
+            'final.drops': final_drops,
+            'n.drops': recommended}
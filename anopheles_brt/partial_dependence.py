@@ -0,0 +1,161 @@
+# Copyright (C) 2009  Anand Patil
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Partial dependence curves and pairwise interaction strengths, as gbm.plot
+# and gbm.interactions in brt.functions.R compute them, but straight from the
+# fitted trees rather than through predict.gbm.
+
+import os
+import numpy as np
+from pylab import rec2csv
+from profiling import profiled
+from brt_wrap import compile_trees, unpack_brt_trees, unpack_gbm_object, load_training_table, get_result_dir
+
+__all__ = ['variable_grids', 'partial_dependence', 'gbm_tree_arrays', 'evaluate_gbm_trees', 'interaction_strengths', 'write_partial_dependence']
+
+def variable_grids(data, names, n_points):
+    "Returns an array of n_points evenly spaced values over the range of each of the named columns of data."
+    return np.array([np.linspace(np.nanmin(data[n]), np.nanmax(data[n]), n_points) for n in names])
+
+def partial_dependence(nice_tree_dict, intercept, data, n_points=100):
+    """
+    Takes the output of unpack_brt_trees, the intercept and the training
+    table. Because the model is a sum of one step function per predictor,
+    the partial dependence on a predictor is exactly its step function plus
+    the intercept and the mean contributions of the other predictors over
+    the training data.
+
+    Returns the predictor names, an array of grid values over each one's
+    range and an array of the partial dependences on the grids, on the
+    link scale.
+    """
+    names = data.dtype.names[1:]
+    grids = variable_grids(data, names, n_points)
+    curves = np.zeros(grids.shape)
+    means = np.zeros(len(names))
+    for i, n in enumerate(names):
+        trees = nice_tree_dict.get(n)
+        if trees is None:
+            continue
+        splits, table = compile_trees(trees)
+        curves[i] = table[np.searchsorted(splits, grids[i], side='right')]
+        v = data[n][~np.isnan(data[n])]
+        means[i] = np.mean(table[np.searchsorted(splits, v, side='right')])
+    return names, grids, curves + intercept + (np.sum(means) - means)[:,None]
+
+def gbm_tree_arrays(tree_matrix):
+    """
+    Converts the 'trees' element of a gbm.object from either backend into
+    arrays of split variables, split values, left, right and missing
+    nodes and predictions, each with one row per tree. Trees with fewer
+    nodes than the largest are padded with terminal nodes.
+    """
+    n_nodes = max([len(t[0]) for t in tree_matrix])
+    out = [np.zeros((len(tree_matrix), n_nodes)) for i in xrange(6)]
+    out[0].fill(-1)
+    for i, t in enumerate(tree_matrix):
+        for a, k in zip(out, [0,1,2,3,4,7]):
+            a[i,:len(t[k])] = t[k]
+    split_var, split_val, left, right, missing, prediction = out
+    return split_var.astype('int'), split_val, left.astype('int'), right.astype('int'), missing.astype('int'), prediction
+
+def evaluate_gbm_trees(tree_arrays, x, chunk=1000000):
+    """
+    Evaluates a whole ensemble of trees of any depth, laid out by
+    gbm_tree_arrays, at the rows of the (n,p) array x. Every tree is walked
+    down a level at a time for a batch of points at once. Returns the sum
+    of the trees' predictions, without the intercept.
+    """
+    split_var, split_val, left, right, missing, prediction = tree_arrays
+    n_trees, n_nodes = split_var.shape
+    out = np.empty(len(x))
+    step = max(1, chunk//n_trees)
+    t = np.arange(n_trees)[:,None]
+    for start in xrange(0, len(x), step):
+        xc = x[start:start+step]
+        rows = np.arange(len(xc))[None,:]
+        node = np.zeros((n_trees, len(xc)), dtype='int')
+        for level in xrange(n_nodes):
+            v = split_var[t, node]
+            internal = v >= 0
+            if not internal.any():
+                break
+            xv = xc[rows, np.where(internal, v, 0)]
+            s = split_val[t, node]
+            next_node = np.where(np.isnan(xv), missing[t, node], np.where(xv < s, left[t, node], right[t, node]))
+            node = np.where(internal, next_node, node)
+        out[start:start+step] = prediction[t, node].sum(axis=0)
+    return out
+
+def interaction_strengths(tree_matrix, data, n_points=20):
+    """
+    The interaction statistic of gbm.interactions for every pair of
+    predictors: predictions on the link scale over an n_points by n_points
+    grid of the pair, with the other predictors at their means, are fit
+    with an additive model in the two predictors as factors, and the
+    statistic is 1000 times the mean squared residual. On a complete grid
+    that fit is the row means plus the column means less the grand mean,
+    so all the pairs are done at once.
+
+    Models made of stumps have no interactions, so if every tree has a
+    single split the statistics are zero and the grid is not evaluated.
+    Returns the predictor names and a symmetric matrix of the statistics.
+    """
+    names = data.dtype.names[1:]
+    p = len(names)
+    tree_arrays = gbm_tree_arrays(tree_matrix)
+    if np.all((tree_arrays[0] >= 0).sum(axis=1) <= 1):
+        return names, np.zeros((p,p))
+    grids = variable_grids(data, names, n_points)
+    means = np.array([np.mean(data[n][~np.isnan(data[n])]) for n in names])
+
+    pairs = [(i,j) for i in xrange(p) for j in xrange(i+1,p)]
+    x = np.empty((len(pairs), n_points, n_points, p))
+    x[:] = means
+    for k, (i,j) in enumerate(pairs):
+        x[k,:,:,i] = grids[i][:,None]
+        x[k,:,:,j] = grids[j][None,:]
+
+    pred = evaluate_gbm_trees(tree_arrays, x.reshape((-1,p))).reshape((len(pairs), n_points, n_points))
+    resid = pred - pred.mean(axis=2)[:,:,None] - pred.mean(axis=1)[:,None,:] + pred.mean(axis=2).mean(axis=1)[:,None,None]
+
+    strengths = np.zeros((p,p))
+    for k, (i,j) in enumerate(pairs):
+        strengths[i,j] = strengths[j,i] = 1000*np.mean(resid[k]**2)
+    return names, strengths
+
+@profiled('write_partial_dependence')
+def write_partial_dependence(brt_results, fname, species_name, layer_names, glob_name, glob_channels):
+    """
+    Writes the partial dependence curves, centred as gbm.plot centres them,
+    and the pairwise interaction strengths of a fitted model to the
+    species' results directory.
+    """
+    data = load_training_table(fname)
+    nice_tree_dict = unpack_brt_trees(brt_results, layer_names, glob_name, glob_channels)
+    intercept = unpack_gbm_object(brt_results, 'initF')[0][0]
+    result_dirname = get_result_dir(species_name)
+
+    names, grids, curves = partial_dependence(nice_tree_dict, intercept, data)
+    n_points = grids.shape[1]
+    rec2csv(np.rec.fromarrays([np.repeat(names, n_points), grids.ravel(), (curves - curves.mean(axis=1)[:,None]).ravel(), curves.ravel()],
+                names='variable,value,fitted_function,link'), os.path.join(result_dirname, 'partial-dependence.csv'))
+
+    names, strengths = interaction_strengths(unpack_gbm_object(brt_results, 'trees')[0], data)
+    rec2csv(np.rec.fromarrays([np.array(names)] + list(strengths.T), names=['variable']+list(names)), os.path.join(result_dirname, 'interactions.csv'))
+    i, j = np.array([(i,j) for i in xrange(len(names)) for j in xrange(i+1,len(names))], dtype=int).reshape((-1,2)).T
+    order = np.argsort(-strengths[i,j], kind='mergesort')
+    rec2csv(np.rec.fromarrays([np.array(names)[i[order]], np.array(names)[j[order]], strengths[i,j][order]], names='var1,var2,interaction'),
+                os.path.join(result_dirname, 'interactions-ranked.csv'))
@@ -0,0 +1,136 @@
+# Copyright (C) 2009  Anand Patil
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Per-stage metrics. Functions decorated with profiled append one JSON object
+# per call to the log named by profile_to, if there is one; otherwise the
+# decorator does nothing but call the function.
+
+import os
+import sys
+import time
+import json
+import resource
+import functools
+from caching import anopheles_cache
+
+__all__ = ['profile_to', 'profiled', 'summarize_profiles']
+
+log_fname = None
+log_context = {}
+
+def profile_to(fname, **context):
+    """
+    Makes profiled functions called in this process append their records
+    to fname, with the keyword arguments added to every record. Pass None
+    to stop profiling.
+    """
+    global log_fname, log_context
+    log_fname = fname
+    log_context = context
+
+def io_counters():
+    "Returns the counters in /proc/self/io, or an empty dictionary where there is no such file."
+    try:
+        return dict([(k, int(v)) for k, v in [l.split(':') for l in file('/proc/self/io')]])
+    except IOError:
+        return {}
+
+def snapshot():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return {'wall': time.time(),
+            'cpu_user': usage.ru_utime,
+            'cpu_system': usage.ru_stime,
+            'io': io_counters(),
+            'cache_hits': anopheles_cache.hits,
+            'cache_misses': anopheles_cache.misses}
+
+def write_record(record):
+    # A single write to a file opened for appending, so lines from
+    # different processes do not interleave.
+    fd = os.open(log_fname, os.O_WRONLY|os.O_APPEND|os.O_CREAT, 0644)
+    try:
+        os.write(fd, json.dumps(record)+'\n')
+    finally:
+        os.close(fd)
+
+def profiled(stage, count=None, unit='rows'):
+    """
+    A decorator that records the wall and CPU time, peak resident set size,
+    bytes read, anopheles_cache hits and misses and, if count is given,
+    count(result) in the given unit, of every call to the function.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if log_fname is None:
+                return fn(*args, **kwargs)
+            before = snapshot()
+            error = None
+            try:
+                result = fn(*args, **kwargs)
+                return result
+            except Exception, e:
+                error = '%s: %s'%(e.__class__.__name__, e)
+                raise
+            except:
+                # KeyboardInterrupt, SystemExit and the like.
+                error = sys.exc_info()[0].__name__
+                raise
+            finally:
+                after = snapshot()
+                record = dict(log_context)
+                record.update({'stage': stage, 'pid': os.getpid(), 'start': before['wall'],
+                    'wall': after['wall']-before['wall'],
+                    'cpu_user': after['cpu_user']-before['cpu_user'],
+                    'cpu_system': after['cpu_system']-before['cpu_system'],
+                    # ru_maxrss is in kilobytes on Linux.
+                    'peak_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024,
+                    'read_bytes': after['io'].get('read_bytes',0)-before['io'].get('read_bytes',0),
+                    'rchar': after['io'].get('rchar',0)-before['io'].get('rchar',0),
+                    'cache_hits': after['cache_hits']-before['cache_hits'],
+                    'cache_misses': after['cache_misses']-before['cache_misses'],
+                    'error': error})
+                if count is not None and error is None:
+                    record['count'] = int(count(result))
+                    record['count_unit'] = unit
+                write_record(record)
+        return wrapper
+    return decorator
+
+def summarize_profiles(fnames):
+    """
+    Reads the JSON-lines logs in fnames and returns, for each stage, the
+    number of calls and errors, total wall and CPU time, bytes read, cache
+    hits and misses and counts, and the largest peak RSS.
+    """
+    stages = {}
+    for fname in fnames:
+        if not os.path.exists(fname):
+            continue
+        for line in file(fname):
+            r = json.loads(line)
+            s = stages.setdefault(r['stage'], {'calls': 0, 'errors': 0, 'wall': 0., 'cpu': 0., 'read_bytes': 0, 'rchar': 0,
+                                                'cache_hits': 0, 'cache_misses': 0, 'count': 0, 'peak_rss_bytes': 0})
+            s['calls'] += 1
+            s['errors'] += r['error'] is not None
+            s['wall'] += r['wall']
+            s['cpu'] += r['cpu_user'] + r['cpu_system']
+            for k in ['read_bytes','rchar','cache_hits','cache_misses']:
+                s[k] += r[k]
+            s['count'] += r.get('count', 0)
+            if 'count_unit' in r:
+                s['count_unit'] = r['count_unit']
+            s['peak_rss_bytes'] = max(s['peak_rss_bytes'], r['peak_rss_bytes'])
+    return stages
@@ -21,8 +21,11 @@ import sys, os
 import shapely
 import hashlib
 import cPickle
+import shutil
+from caching import anopheles_cache
+from profiling import profiled
 
-__all__ = ['site_to_rec', 'sitelist_to_recarray', 'list_species', 'species_query', 'multipoint_to_ndarray', 'point_to_ndarray', 'sites_as_ndarray']
+__all__ = ['site_to_rec', 'sitelist_to_recarray', 'list_species', 'species_query', 'multipoint_to_ndarray', 'point_to_ndarray', 'sites_as_ndarray', 'prefetch_sites', 'stored_species']
 
 def multipoint_to_ndarray(mp):
     "Converts a multipont to a coordinate array IN RADIANS."
@@ -64,19 +67,200 @@ def map_extents(pos_recs, eo):
             max(pos_recs.x.max(), eo.bounds[2]),
             max(pos_recs.y.max(), eo.bounds[3])]
 
+# The sites and EOs of many species, fetched up front by prefetch_sites, live
+# in one HDF5 file in the cache with a group per species id. The file is only
+# ever replaced whole, by anopheles_cache.write, so it can be read without a
+# lock.
+site_store_fname = 'site-store.hdf5'
+
+def store_group(species_id):
+    return '/species_%s'%species_id
+
+# WKB geometry type codes.
+wkb_point = 1
+wkb_multipoint = 4
+
+def wkb_numbers(buf, starts, dtype, big_endian):
+    "Reads one number of the given little-endian dtype at each of the byte offsets starts in buf."
+    size = np.dtype(dtype).itemsize
+    b = buf[starts[:,None] + np.arange(size)]
+    b[big_endian] = b[big_endian,::-1]
+    return b.view(dtype).ravel()
+
+def decode_wkb_points(wkbs):
+    """
+    Decodes a list of WKB points and multipoints in one pass. Returns 
+    breaks and x, such that x[breaks[i]:breaks[i+1]] are the coordinates 
+    of the i'th geometry, and whether any of them were multipoints.
+    """
+    if len(wkbs) == 0:
+        return np.zeros(1, dtype='int'), np.zeros((0,2)), False
+    lengths = np.array(map(len, wkbs), dtype='int')
+    offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    buf = np.fromstring(''.join(wkbs), dtype='uint8')
+
+    # A point is: byte order, type and two doubles. A multipoint is: byte 
+    # order, type, count and then that many points.
+    big_endian = buf[offsets] == 0
+    types = wkb_numbers(buf, offsets+1, '<u4', big_endian)
+    is_multi = types == wkb_multipoint
+    if not np.all(is_multi | (types == wkb_point)):
+        raise ValueError, 'Your list of sites has something in it that is neither a multipoint nor a point, you fruitcake.'
+    counts = np.ones(len(wkbs), dtype='int')
+    counts[is_multi] = wkb_numbers(buf, offsets[is_multi]+5, '<u4', big_endian[is_multi])
+    breaks = np.concatenate(([0], np.cumsum(counts)))
+
+    # Byte offset of the first coordinate of each point.
+    first = np.where(is_multi, offsets+9+5, offsets+5)
+    within = np.arange(breaks[-1]) - np.repeat(breaks[:-1], counts)
+    starts = np.repeat(first, counts) + 21*within
+    # Each point in a multipoint has its own byte order.
+    point_big_endian = buf[starts-5] == 0
+    x = np.empty((breaks[-1], 2))
+    x[:,0] = wkb_numbers(buf, starts, '<f8', point_big_endian)
+    x[:,1] = wkb_numbers(buf, starts+8, '<f8', point_big_endian)
+    return breaks, x, bool(np.any(is_multi))
+
+def site_column(column):
+    "Converts a column of counts from the database to integers, with None as 0."
+    column = np.array(column, dtype=object)
+    column[np.equal(column, None)] = 0
+    return column.astype('int')
+
+def site_arrays(sites):
+    """
+    Converts the sites returned by species_query to breaks, x, found, zero,
+    others_found and multipoints. The geometries may be shapely points and
+    multipoints or their WKB strings. found, zero and others_found have an
+    entry per site, and x a row per point; site i's points are
+    x[breaks[i]:breaks[i+1]].
+    """
+    if len(sites) == 0:
+        empty = np.zeros(0, dtype='int')
+        return np.zeros(1, dtype='int'), np.zeros((0,2)), empty, empty, empty, False
+    geoms, found, zero, others_found = zip(*sites)[:4]
+    
+    # Forget about non-records
+    keep = np.array([g is not None for g in geoms])
+    
+    # The only work done per site is getting its WKB.
+    breaks, x, multipoints = decode_wkb_points([g if isinstance(g, str) else g.wkb for g in geoms if g is not None])
+    found, zero, others_found = [site_column(c)[keep] for c in (found, zero, others_found)]
+    return breaks, x, found, zero, others_found, multipoints
+
+def write_site_arrays(hf, where, arrays, eo):
+    "Writes the output of site_arrays and the EO under the group where in an open HDF5 file."
+    breaks, x, found, zero, others_found, multipoints = arrays
+    hf.createArray(where,'breaks',breaks)
+    hf.createArray(where,'x',x)
+    hf.createArray(where,'found',found)
+    hf.createArray(where,'zero',zero)
+    hf.createArray(where,'others_found',others_found)
+    hf.createArray(where,'multipoints',[multipoints])
+    hf.createVLArray(where,'eo',tb.ObjectAtom())
+    hf.getNode(where,'eo').append(eo)
+
+def read_site_arrays(hf, where):
+    "Reads what write_site_arrays wrote. Returns breaks, x, found, zero, others_found, multipoints, eo."
+    return tuple([hf.getNode(where,n)[:] for n in ['breaks','x','found','zero','others_found']] \
+                    + [hf.getNode(where,n)[0] for n in ['multipoints','eo']])
+
+def stored_species():
+    "Returns the set of species ids in the site store."
+    if site_store_fname not in anopheles_cache:
+        return set()
+    hf = tb.openFile(anopheles_cache.path(site_store_fname))
+    try:
+        return set([hf.getNodeAttr(g, 'species_id') for g in hf.root._v_groups.itervalues()])
+    finally:
+        hf.close()
+
+def sites_from_store(species):
+    "Returns the output of sites_as_ndarray from the site store, or None if the species is not in it."
+    if site_store_fname not in anopheles_cache:
+        return None
+    hf = tb.openFile(anopheles_cache.path(site_store_fname))
+    try:
+        if store_group(species[0]) not in hf:
+            return None
+        return read_site_arrays(hf, store_group(species[0]))
+    finally:
+        hf.close()
+
+@profiled('prefetch_sites', count=lambda r: len(r), unit='errors')
+def prefetch_sites(session, species_list):
+    """
+    Queries the sites and EOs of every species in species_list, a list of
+    (id, name) tuples, through one session, and adds them to the site store
+    in the cache. Species already in the store are not queried again.
+    After this, sites_as_ndarray reads those species from the store without
+    touching the database or taking a lock.
+
+    A species whose query fails is left out of the store, so that it fails
+    again, on its own, in sites_as_ndarray. Returns a dictionary of error
+    messages by species id.
+    """
+    store_lock = anopheles_cache.lock(site_store_fname)
+    store_lock.acquire()
+    try:
+        have = stored_species()
+        new = [sp for sp in species_list if sp[0] not in have]
+        fetched = []
+        errors = {}
+        for sp in new:
+            try:
+                sites, eo = species_query(session, sp[0])
+                fetched.append((sp, site_arrays(sites), eo))
+            except Exception, e:
+                errors[sp[0]] = '%s: %s'%(e.__class__.__name__, e)
+        if len(fetched)==0:
+            return errors
+
+        def writer(f):
+            # The existing species are copied, and the new ones added.
+            if have:
+                shutil.copyfile(anopheles_cache.path(site_store_fname), f)
+            hf = tb.openFile(f,'a')
+            try:
+                for sp, arrays, eo in fetched:
+                    g = hf.createGroup('/', store_group(sp[0])[1:])
+                    hf.setNodeAttr(g, 'species_id', sp[0])
+                    hf.setNodeAttr(g, 'species_name', sp[1])
+                    write_site_arrays(hf, g, arrays, eo)
+            finally:
+                hf.close()
+        anopheles_cache.write(site_store_fname, writer)
+        return errors
+    finally:
+        store_lock.release()
+
+@profiled('sites_as_ndarray', count=lambda r: len(r[1]))
 def sites_as_ndarray(session, species):
+    """
+    Returns breaks, x, found, zero, others_found, multipoints and eo for
+    species, an (id, name) tuple. Species that prefetch_sites has fetched
+    are read from the site store; others are queried and cached one at a
+    time.
+    """
+    stored = sites_from_store(species)
+    if stored is not None:
+        return stored
     
     fname = '%s_sites.hdf5'%(species[1])
     
-    if fname in os.listdir('anopheles-caches'):
-        hf = tb.openFile(os.path.join('anopheles-caches', fname))
-        breaks = hf.root.breaks[:]
-        x = hf.root.x[:]
-        found = hf.root.found[:]
-        zero = hf.root.zero[:]
-        others_found = hf.root.others_found[:]
-        multipoints = hf.root.multipoints[0]
-        eo = hf.root.eo[0]
+    key_lock = anopheles_cache.lock(fname)
+    key_lock.acquire()
+    try:
+        return sites_from_cache(session, species, fname)
+    finally:
+        key_lock.release()
+
+def sites_from_cache(session, species, fname):
+    "Does the work of sites_as_ndarray while the caller holds the lock on fname."
+    
+    if fname in anopheles_cache:
+        hf = tb.openFile(anopheles_cache.path(fname))
+        breaks, x, found, zero, others_found, multipoints, eo = read_site_arrays(hf, '/')
         hf.close()
     
     else:
@@ -84,48 +268,13 @@ def sites_as_ndarray(session, species):
         sites, eo = species_query(session, species[0])
         sites, eo = species_query(session, species[0])
         
-        # Forget about non-records
-        sites = filter(lambda s:s[0] is not None, sites)
+        breaks, x, found, zero, others_found, multipoints = site_arrays(sites)
         
-        x = []
-        breaks = [0]
-        found = []
-        zero = []
-        others_found = []
-        totals = []
-    
-        multipoints = False
-        for site in sites:
-            if isinstance(site[0], shapely.geometry.multipoint.MultiPoint):
-                x.append(multipoint_to_ndarray(site[0]))
-                breaks.append(breaks[-1] + len(site[0].geoms))
-                multipoints = True
-            if isinstance(site[0], shapely.geometry.point.Point):
-                x.append(np.atleast_2d(point_to_ndarray(site[0])))
-                breaks.append(breaks[-1] + 1)
-            else:
-                raise ValueError, 'Your list of sites has something in it that is neither a multipoint nor a point, you fruitcake.'
-            found.append(site[1] or 0)
-            zero.append(site[2] or 0)
-            others_found.append(site[3] or 0)
-            totals.append(site[4])
-    
-        breaks = np.array(breaks)
-        x = np.concatenate(x)
-        found = np.array(found)
-        zero = np.array(zero)
-        others_found = np.array(others_found)
-        
-        hf = tb.openFile(os.path.join('anopheles-caches', fname),'w')
-        hf.createArray('/','breaks',breaks)
-        hf.createArray('/','x',x)
-        hf.createArray('/','found',found)
-        hf.createArray('/','zero',zero)
-        hf.createArray('/','others_found',others_found)
-        hf.createArray('/','multipoints',[multipoints])
-        hf.createVLArray('/','eo',tb.ObjectAtom())
-        hf.root.eo.append(eo)
-        hf.close()
+        def writer(f):
+            hf = tb.openFile(f,'w')
+            write_site_arrays(hf, '/', (breaks, x, found, zero, others_found, multipoints), eo)
+            hf.close()
+        anopheles_cache.write(fname, writer)
     
     return breaks, x, found, zero, others_found, multipoints, eo
     
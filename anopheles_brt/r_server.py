@@ -0,0 +1,279 @@
+# Copyright (C) 2009  Anand Patil
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Long-lived R processes for brt(). Each worker embeds R, sources
+# brt.functions.R and loads gbm once, then fits gbm.step for any number of
+# clients over a Unix socket in a shared directory. serve_r_workers runs a pool
+# of them until it is stopped, so they stay warm across species and runs.
+#
+# Every fit is evaluated in a fresh R environment, and the gbm.object comes
+# back converted to NumPy arrays, so nothing is left in R's global environment
+# between jobs.
+
+import os
+import sys
+import time
+import traceback
+import multiprocessing
+from multiprocessing.connection import Listener, Client, AuthenticationError
+from caching import cache_lock
+from numpy_gbm import numpy_gbm_result
+import numpy as np
+
+__all__ = ['r_worker_pool', 'r_workers', 'serve_r_workers', 'fit_gbm_step']
+
+r_ready = False
+
+def setup_r():
+    "Sources brt.functions.R and loads gbm into this process's R, once."
+    global r_ready
+    from rpy2.robjects import r
+    if not r_ready:
+        r.source(os.path.join(os.path.dirname(os.path.abspath(__file__)),'brt.functions.R'))
+        r('suppressMessages(require(gbm))')
+        r_ready = True
+    return r
+
+def r_to_python(x, r):
+    """
+    Converts an R object to NumPy arrays: data frames to record arrays,
+    lists to dictionaries if they have names and lists otherwise, and
+    vectors to arrays.
+    """
+    from brt_wrap import df_to_ra
+    if r('is.data.frame')(x)[0]:
+        return df_to_ra(r('function(d) {d[] <- lapply(d, function(v) if (is.factor(v)) as.character(v) else v); d}')(x))
+    if r('is.list')(x)[0]:
+        names = r('names')(x)
+        items = [r_to_python(v, r) for v in x]
+        if r('is.null')(names)[0]:
+            return items
+        return dict(zip(names, items))
+    if r('is.factor')(x)[0]:
+        x = r('as.character')(x)
+    if r('is.null')(x)[0]:
+        return None
+    return np.array(x)
+
+def fit_gbm_step(table_path, opt_argstr, save_path=None, seed=None):
+    """
+    Runs gbm.step in a fresh environment on the training table at
+    table_path, written by write_training_table, with the options in
+    opt_argstr, after seeding R's generator with seed if it is given. Saves the gbm.object to save_path if it is given, and
+    returns it as a numpy_gbm_result. Each element's printed form in R
+    is kept in its printed attribute, except for the trees.
+    """
+    from brt_wrap import training_table_to_r
+    r = setup_r()
+    env = r('new.env()')
+    df = training_table_to_r(table_path)
+    r('assign')('training', df, envir=env)
+    argstr = ', '.join(['data=training, gbm.x=2:%i, gbm.y=1, family="bernoulli", silent=TRUE'%len(df.colnames)] + ([opt_argstr] if opt_argstr else []))
+    if seed is not None:
+        r('set.seed')(int(seed))
+    gbm_object = r('function(code, env) eval(parse(text=code), envir=env)')('gbm.object <- gbm.step(%s)'%argstr, env)
+    if r('is.null')(gbm_object)[0]:
+        raise ValueError, 'gbm.step returned NULL'
+    if save_path is not None:
+        r('function(env, f) save(gbm.object, file=f, envir=env)')(env, save_path)
+
+    names = list(r('names')(gbm_object))
+    elements = []
+    printed = {}
+    for n, v in zip(names, gbm_object):
+        if n == 'trees':
+            elements.append((n, [[np.array(node) for node in tree] for tree in v]))
+            continue
+        if n == 'gbm.call':
+            # The call holds a copy of the whole training table.
+            v = r('function(l) {l$dataframe <- NULL; l}')(v)
+        elements.append((n, r_to_python(v, r)))
+        printed[n] = '\n'.join(r('function(v) capture.output(print(v))')(v))
+    return numpy_gbm_result(elements, printed=printed)
+
+def r_worker(address, authkey):
+    "Runs in a worker process: warms R up, then serves fits on address until it is told to stop."
+    setup_r()
+    if os.path.exists(address):
+        os.remove(address)
+    listener = Listener(address, 'AF_UNIX', authkey=authkey)
+    # So that clients can tell a live worker from a socket left by a dead one.
+    file(address+'.pid','w').write(str(os.getpid()))
+    while True:
+        try:
+            conn = listener.accept()
+        except (IOError, EOFError, AuthenticationError):
+            continue
+        try:
+            while True:
+                try:
+                    job = conn.recv()
+                except EOFError:
+                    break
+                if job[0] == 'stop':
+                    conn.send(('done', None))
+                    listener.close()
+                    os.remove(address+'.pid')
+                    return
+                try:
+                    conn.send(('done', fit_gbm_step(*job[1:])))
+                except:
+                    conn.send(('failed', ''.join(traceback.format_exception(*sys.exc_info()))))
+        finally:
+            conn.close()
+
+def serve_r_workers(dirname, n_workers, min_uptime=10):
+    """
+    Starts n_workers R workers listening on sockets in dirname, and waits
+    for them. They exit when sent a stop job, as r_worker_pool.stop does.
+    A worker that dies otherwise, as when R crashes, is restarted on the
+    same socket, unless it died within min_uptime seconds of starting,
+    in which case it would probably die again. Its socket is removed.
+    """
+    if not os.path.isdir(dirname):
+        os.mkdir(dirname)
+    keyfile = os.path.join(dirname, 'authkey')
+    fd = os.open(keyfile, os.O_WRONLY|os.O_CREAT|os.O_TRUNC, 0600)
+    authkey = os.urandom(20)
+    os.write(fd, authkey)
+    os.close(fd)
+    addresses = [os.path.join(os.path.abspath(dirname), 'worker-%i.sock'%i) for i in xrange(n_workers)]
+
+    def start(i):
+        p = multiprocessing.Process(target=r_worker, args=(addresses[i], authkey))
+        p.start()
+        return p, time.time()
+
+    processes = dict([(i, start(i)) for i in xrange(n_workers)])
+    while processes:
+        time.sleep(1)
+        for i, (p, started) in processes.items():
+            if p.is_alive():
+                continue
+            p.join()
+            if p.exitcode == 0:
+                del processes[i]
+            elif time.time() - started < min_uptime:
+                print 'R worker %i exited with code %s right after starting, so it will not be restarted.'%(i, p.exitcode)
+                for f in [addresses[i], addresses[i]+'.pid']:
+                    if os.path.exists(f):
+                        os.remove(f)
+                del processes[i]
+            else:
+                print 'R worker %i exited with code %s; restarting it.'%(i, p.exitcode)
+                processes[i] = start(i)
+
+def worker_alive(address):
+    "Whether the worker that wrote address's pid file is still running."
+    try:
+        pid = int(file(address+'.pid').read())
+        os.kill(pid, 0)
+    except (IOError, OSError, ValueError):
+        return False
+    # A worker that died after its server did may linger as a zombie.
+    try:
+        return file('/proc/%i/stat'%pid).read().rsplit(')',1)[1].split()[0] != 'Z'
+    except IOError:
+        return True
+
+class r_worker_pool(object):
+    """
+    The client side of the workers started by serve_r_workers in dirname.
+    Each fit goes to the first idle worker, judged by a lock file next to
+    its socket, so any number of processes can share the pool. If they
+    are all busy, the fit waits for one of them. Workers that cannot be
+    reached, because they have died and left their sockets behind, are
+    passed over. If dirname is None or has no workers in it that can be
+    reached, fits run in this process, in the same way.
+    """
+    def __init__(self, dirname=None):
+        self.dirname = dirname
+
+    def addresses(self):
+        if self.dirname is None or not os.path.isdir(self.dirname):
+            return []
+        return [os.path.join(os.path.abspath(self.dirname), f) for f in sorted(os.listdir(self.dirname)) if f.endswith('.sock')]
+
+    def connect(self, address):
+        "Returns a connection to the worker at address, or None if nothing is listening there."
+        # Client would keep trying a dead worker's socket for 20 seconds.
+        if not worker_alive(address):
+            return None
+        try:
+            return Client(address, 'AF_UNIX', authkey=file(os.path.join(self.dirname, 'authkey')).read())
+        except (IOError, EOFError):
+            # Including a worker that died, or is being restarted, while we connected.
+            return None
+
+    def send(self, conn, address, job, lock):
+        "Sends job over conn to the worker at address, whose lock the caller holds, and releases the lock."
+        try:
+            try:
+                conn.send(job)
+                status, result = conn.recv()
+            except EOFError:
+                status, result = 'failed', 'The worker exited without a result, perhaps because R crashed.'
+            finally:
+                conn.close()
+        finally:
+            lock.release()
+        if status == 'failed':
+            raise ValueError, 'R worker %s failed:\n%s'%(address, result)
+        return result
+
+    def call(self, job, fallback):
+        """
+        Sends job to an idle worker, or waits for a busy one if none is
+        idle, and returns the result. If no worker can be reached, returns
+        fallback() instead.
+        """
+        addresses = self.addresses()
+        while addresses:
+            for address in addresses:
+                l = cache_lock(address+'.lock')
+                if l.acquire(blocking=False):
+                    break
+            else:
+                address = addresses[os.getpid()%len(addresses)]
+                l = cache_lock(address+'.lock')
+                l.acquire()
+            conn = self.connect(address)
+            if conn is None:
+                l.release()
+                addresses.remove(address)
+                continue
+            return self.send(conn, address, job, l)
+        return fallback()
+
+    def fit(self, table_path, opt_argstr, save_path=None, seed=None):
+        "Does fit_gbm_step in a worker if there are any that can be reached, or here if not. Paths should be absolute."
+        def here():
+            if self.addresses():
+                print 'None of the R workers in %s can be reached, so process %i is fitting in its own R.'%(self.dirname, os.getpid())
+            return fit_gbm_step(table_path, opt_argstr, save_path, seed)
+        return self.call(('fit', table_path, opt_argstr, save_path, seed), here)
+
+    def stop(self):
+        "Stops every worker, once it has finished what it is doing. The workers remove their sockets."
+        for address in self.addresses():
+            l = cache_lock(address+'.lock')
+            l.acquire()
+            conn = self.connect(address)
+            if conn is None:
+                l.release()
+                continue
+            self.send(conn, address, ('stop',), l)
+
+r_workers = r_worker_pool()
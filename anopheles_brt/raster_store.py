@@ -0,0 +1,101 @@
+# Copyright (C) 2009  Anand Patil
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# A raster store is a directory holding one preprocessed raster as .npy
+# files that can be memory-mapped:
+#   data.npy: the values, in the 'y-x+' view (row 0 is the northernmost row)
+#   mask.npy: True where the raster has no data
+#   lon.npy, lat.npy: the pixel centroids
+#   meta.pickle: the lower-left corners, cell size, shape and the modification
+#       times of the source files, which are used to tell when the store is stale.
+# The 'x+y+' view is data[::-1].T, which costs nothing.
+
+import os
+import shutil
+import cPickle
+import numpy as np
+import map_utils
+from caching import fingerprint
+
+__all__ = ['raster_store_dir', 'source_files', 'store_path', 'import_raster_to_store', 'open_store']
+
+raster_store_dir = 'anopheles-rasters'
+
+def source_files(fname):
+    "The files on disk that a raster name may refer to."
+    base = os.path.splitext(fname)[0]
+    return filter(os.path.exists, set([fname] + [base+ext for ext in ['.flt','.hdr','.asc','.hdf5']]))
+
+def store_path(fname, store_dir=None):
+    "The store of a raster, in store_dir or by default raster_store_dir."
+    return os.path.join(store_dir or raster_store_dir, fingerprint(os.path.abspath(os.path.splitext(fname)[0])))
+
+def source_mtimes(fname):
+    "Modification times of the source files, by absolute path so they match from any working directory."
+    return dict([(os.path.abspath(f), os.path.getmtime(f)) for f in source_files(fname)])
+
+def import_raster_to_store(fname):
+    """
+    Imports a raster with map_utils.import_raster, once, and writes it to
+    the raster store. Returns the store's path. Does nothing if an up-to-date
+    store already exists.
+    """
+    path = store_path(fname)
+    if open_store(fname) is not None:
+        return path
+    if not os.path.isdir(raster_store_dir):
+        os.mkdir(raster_store_dir)
+
+    mtimes = source_mtimes(fname)
+    lon, lat, data, t = map_utils.import_raster(*os.path.split(fname)[::-1])
+    meta = {'fname': fname, 'mtimes': mtimes, 'shape': data.shape, 'lon': lon, 'lat': lat, 'cellsize': lon[1]-lon[0]}
+
+    # Write to a temporary directory and rename it into place, so that
+    # other processes never see a partial store.
+    tmp = path+'.%i.tmp'%os.getpid()
+    if os.path.isdir(tmp):
+        shutil.rmtree(tmp)
+    os.mkdir(tmp)
+    np.save(os.path.join(tmp,'data.npy'), data.data)
+    np.save(os.path.join(tmp,'mask.npy'), np.ma.getmaskarray(data))
+    np.save(os.path.join(tmp,'lon.npy'), lon + meta['cellsize']/2.)
+    np.save(os.path.join(tmp,'lat.npy'), lat + meta['cellsize']/2.)
+    cPickle.dump(meta, file(os.path.join(tmp,'meta.pickle'),'w'))
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    try:
+        os.rename(tmp, path)
+    except OSError:
+        # Another process got there first.
+        shutil.rmtree(tmp)
+    return path
+
+def open_store(fname, store_dir=None):
+    """
+    Returns a dictionary holding the memory-mapped arrays and the metadata
+    of the raster's store in store_dir, by default raster_store_dir, or
+    None if it has not been imported or its source files have changed since.
+    """
+    path = store_path(fname, store_dir)
+    try:
+        meta = cPickle.load(file(os.path.join(path, 'meta.pickle')))
+    except IOError:
+        return None
+    if meta['mtimes'] != source_mtimes(fname):
+        return None
+    store = {'meta': meta}
+    for k in ['data','mask','lon','lat']:
+        store[k] = np.load(os.path.join(path, k+'.npy'), mmap_mode='r')
+    return store
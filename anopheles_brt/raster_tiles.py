@@ -0,0 +1,295 @@
+# Copyright (C) 2009  Anand Patil
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Throughout, rasters are kept in the 'y-x+' view they have on disk:
+# row 0 is the northernmost row.
+
+import os
+import sys
+import numpy as np
+import tables as tb
+import map_utils
+from raster_store import open_store
+
+__all__ = ['read_hdr', 'write_hdr', 'bbox_indices', 'point_indices', 'rasterize_polygon', 'windowed_raster', 'flt_writer', 'h5_map_writer', 'read_map_level', 'map_writer']
+
+def read_hdr(fname):
+    "Reads an ESRI .hdr file into a dictionary with lowercase keys."
+    hdr = {}
+    for line in file(fname):
+        fields = line.split()
+        if len(fields) >= 2:
+            hdr[fields[0].lower()] = fields[1]
+    return hdr
+
+def write_hdr(fname, ncols, nrows, xllcorner, yllcorner, cellsize, nodata):
+    "Writes an ESRI .hdr file describing a native-endian float32 .flt file."
+    byteorder = 'LSBFIRST' if sys.byteorder=='little' else 'MSBFIRST'
+    fout = file(fname,'w')
+    for k, v in [('ncols',ncols),('nrows',nrows),('xllcorner',repr(float(xllcorner))),('yllcorner',repr(float(yllcorner))),
+                    ('cellsize',repr(float(cellsize))),('NODATA_value',nodata),('byteorder',byteorder)]:
+        fout.write('%-14s%s\n'%(k,v))
+    fout.close()
+
+def bbox_indices(lon, lat, bbox):
+    """
+    Takes lower-left corner coordinate vectors and a bounding box
+    (llclat, llclon, urclat, urclon), and returns the indices
+    llclati, llcloni, urclati, urcloni.
+    """
+    llclat,llclon,urclat,urclon = bbox
+    llclati = np.where(lat>=llclat)[0][0]
+    llcloni = np.where(lon>=llclon)[0][0]
+    urclati = np.where(lat<=urclat)[0][-1]
+    urcloni = np.where(lon<=urclon)[0][-1]
+    return llclati, llcloni, urclati, urcloni
+
+def point_indices(lon, lat, x):
+    """
+    Takes lower-left corner coordinate vectors and an (n,2) array of 
+    lon/lat points, and returns the rows and columns of the pixels 
+    containing the points, along with a boolean array that is True for 
+    points outside the grid. The rows and columns of those points are 0.
+    """
+    cols = np.floor((x[:,0]-lon[0])/(lon[1]-lon[0])).astype('int')
+    lat_inds = np.floor((x[:,1]-lat[0])/(lat[1]-lat[0])).astype('int')
+    outside = (cols<0) | (cols>=len(lon)) | (lat_inds<0) | (lat_inds>=len(lat))
+    cols[outside] = 0
+    lat_inds[outside] = len(lat)-1
+    return len(lat)-1-lat_inds, cols, outside
+
+def rasterize_polygon(geom, lon, lat):
+    """
+    Takes a shapely polygon or multipolygon and centroid coordinate vectors,
+    and returns a boolean array in the 'y-x+' view that is True for pixels 
+    whose centroids are inside the polygon. Other geometries inside 
+    collections are ignored.
+    """
+    from matplotlib.path import Path
+    centroids = np.array([np.tile(lon, len(lat)), np.repeat(lat[::-1], len(lon))]).T
+    inside = np.zeros(len(centroids), dtype='bool')
+    for poly in getattr(geom, 'geoms', [geom]):
+        if not hasattr(poly, 'exterior'):
+            continue
+        in_poly = Path(np.asarray(poly.exterior.coords)).contains_points(centroids)
+        for hole in poly.interiors:
+            in_poly &= ~Path(np.asarray(hole.coords)).contains_points(centroids)
+        inside |= in_poly
+    return inside.reshape((len(lat), len(lon)))
+
+class windowed_raster(object):
+    """
+    Opens a raster so that windows of rows can be read one at a time.
+    If the raster has been imported into the raster store, or is available 
+    as a .flt/.hdr pair, it is memory-mapped, so only the windows that are 
+    read are paged in. Otherwise it is imported in full with 
+    map_utils.import_raster. store_dir is the raster store to look in,
+    by default raster_store.raster_store_dir.
+
+    lon and lat are the lower-left corners of the pixels, as returned by
+    map_utils.import_raster.
+    """
+    def __init__(self, fname, store_dir=None):
+        self.fname = fname
+        base = os.path.splitext(fname)[0]
+        store = open_store(fname, store_dir)
+        if store is not None:
+            self.data = store['data']
+            self.mask = store['mask']
+            self.lon = store['meta']['lon']
+            self.lat = store['meta']['lat']
+        elif os.path.exists(base+'.flt') and os.path.exists(base+'.hdr'):
+            hdr = read_hdr(base+'.hdr')
+            ncols = int(hdr['ncols'])
+            nrows = int(hdr['nrows'])
+            cellsize = float(hdr['cellsize'])
+            xll = float(hdr.get('xllcorner', hdr.get('xllcenter')))
+            yll = float(hdr.get('yllcorner', hdr.get('yllcenter')))
+            if 'xllcenter' in hdr:
+                xll -= cellsize/2.
+                yll -= cellsize/2.
+            dtype = '>f4' if hdr.get('byteorder','lsbfirst').lower()=='msbfirst' else '<f4'
+            self.nodata = float(hdr.get('nodata_value', -9999))
+            self.data = np.memmap(base+'.flt', dtype=dtype, mode='r', shape=(nrows,ncols))
+            self.lon = xll + np.arange(ncols)*cellsize
+            self.lat = yll + np.arange(nrows)*cellsize
+            self.mask = None
+        else:
+            self.lon, self.lat, data, t = map_utils.import_raster(*os.path.split(fname)[::-1])
+            self.data = data.data
+            self.mask = np.ma.getmaskarray(data)
+        self.shape = self.data.shape
+
+    def rows(self, start, stop, cols=slice(None)):
+        "Returns rows start:stop, columns cols, as a masked array."
+        data = np.asarray(self.data[start:stop, cols])
+        if self.mask is None:
+            mask = (data==self.nodata) | np.isnan(data)
+        else:
+            mask = self.mask[start:stop, cols]
+        return np.ma.masked_array(data, mask=mask)
+
+    def pixels(self, rows, cols):
+        "Returns the pixels at the given rows and columns as a masked array."
+        data = np.asarray(self.data[rows, cols])
+        if self.mask is None:
+            mask = (data==self.nodata) | np.isnan(data)
+        else:
+            mask = self.mask[rows, cols]
+        return np.ma.masked_array(data, mask=mask)
+
+class flt_writer(object):
+    """
+    Creates a float32 .flt/.hdr pair on disk and memory-maps it so that
+    it can be written a window of rows at a time. lon and lat are the
+    lower-left corners of the pixels.
+    """
+    def __init__(self, fname, lon, lat, nodata=-9999):
+        base = os.path.splitext(fname)[0]
+        self.fname = base+'.flt'
+        self.nodata = nodata
+        write_hdr(base+'.hdr', len(lon), len(lat), lon[0], lat[0], lon[1]-lon[0], nodata)
+        self.data = np.memmap(self.fname, dtype='float32', mode='w+', shape=(len(lat),len(lon)))
+
+    def write_rows(self, start, data):
+        "Writes the masked array data into the map, starting at row start."
+        self.data[start:start+data.shape[0]] = np.ma.filled(data, self.nodata)
+
+    def close(self):
+        self.data.flush()
+        del self.data
+
+def overview_name(level):
+    return 'map' if level==0 else 'overview%i'%level
+
+class h5_map_writer(object):
+    """
+    Writes a map to an HDF5 file as a chunked, zlib-compressed float32
+    array, a window of rows at a time, as flt_writer does. The rows must
+    be written in order, from the north.
+
+    Overviews are built as the rows arrive. Level l is in the array 
+    overview<l>, and each of its pixels is the mean of the unmasked map 
+    pixels in a 2**l by 2**l block, anchored at the north-west corner. 
+    Levels are added until one fits in a single chunk. Every array carries
+    its grid in the attributes xllcorner, yllcorner, cellsize and 
+    nodata_value, and read_map_level reads them back.
+    """
+    def __init__(self, fname, lon, lat, nodata=-9999, chunk=256, complevel=5):
+        self.fname = os.path.splitext(fname)[0]+'.h5'
+        self.nodata = nodata
+        self.hf = tb.openFile(self.fname, 'w')
+        filters = tb.Filters(complevel=complevel, complib='zlib', shuffle=True)
+        cellsize = lon[1]-lon[0]
+        top = lat[0] + len(lat)*cellsize
+        shape = (len(lat), len(lon))
+        self.levels = []
+        while True:
+            a = self.hf.createCArray('/', overview_name(len(self.levels)), tb.Float32Atom(dflt=nodata), shape, 
+                                        filters=filters, chunkshape=(min(chunk,shape[0]), min(chunk,shape[1])))
+            factor = 2**len(self.levels)
+            a._v_attrs.factor = factor
+            a._v_attrs.xllcorner = lon[0]
+            a._v_attrs.yllcorner = top - shape[0]*cellsize*factor
+            a._v_attrs.cellsize = cellsize*factor
+            a._v_attrs.nodata_value = nodata
+            self.levels.append(a)
+            if max(shape) <= chunk:
+                break
+            shape = ((shape[0]+1)//2, (shape[1]+1)//2)
+        self.hf.root._v_attrs.n_levels = len(self.levels)
+        self.next_row = [0]*len(self.levels)
+        # A row of sums and counts left over at each level, waiting for its pair.
+        self.pending = [None]*len(self.levels)
+
+    def write_rows(self, start, data):
+        "Writes the masked array data into the map, starting at row start."
+        if start != self.next_row[0]:
+            raise ValueError, 'Rows must be written in order; expected row %i, got %i.'%(self.next_row[0], start)
+        filled = np.ma.filled(data, self.nodata).astype('float32')
+        self.levels[0][start:start+data.shape[0]] = filled
+        self.next_row[0] += data.shape[0]
+        notmask = ~np.ma.getmaskarray(data)
+        self.reduce(1, np.where(notmask, filled, 0).astype('float64'), notmask.astype('int'))
+
+    def reduce(self, level, sums, counts, final=False):
+        "Adds rows of sums and counts of the level below to the overview at level."
+        if level == len(self.levels):
+            return
+        if self.pending[level] is not None:
+            sums = np.vstack((self.pending[level][0], sums))
+            counts = np.vstack((self.pending[level][1], counts))
+            self.pending[level] = None
+        if len(sums) % 2:
+            if final:
+                sums = np.vstack((sums, np.zeros_like(sums[:1])))
+                counts = np.vstack((counts, np.zeros_like(counts[:1])))
+            else:
+                self.pending[level] = (sums[-1:], counts[-1:])
+                sums, counts = sums[:-1], counts[:-1]
+        if sums.shape[1] % 2:
+            sums = np.hstack((sums, np.zeros_like(sums[:,:1])))
+            counts = np.hstack((counts, np.zeros_like(counts[:,:1])))
+
+        sums = sums[0::2] + sums[1::2]
+        sums = sums[:,0::2] + sums[:,1::2]
+        counts = counts[0::2] + counts[1::2]
+        counts = counts[:,0::2] + counts[:,1::2]
+        if len(sums) > 0:
+            out = np.empty(sums.shape, dtype='float32')
+            out.fill(self.nodata)
+            where_data = counts > 0
+            out[where_data] = sums[where_data]/counts[where_data]
+            self.levels[level][self.next_row[level]:self.next_row[level]+len(out)] = out
+            self.next_row[level] += len(out)
+        elif not final:
+            return
+        self.reduce(level+1, sums, counts, final)
+
+    def close(self):
+        self.reduce(1, np.zeros((0, self.levels[0].shape[1])), np.zeros((0, self.levels[0].shape[1]), dtype='int'), final=True)
+        self.hf.close()
+
+def read_map_level(fname, level=0, bbox=None):
+    """
+    Reads an overview level of a map written by h5_map_writer, level 0
+    being the map itself, or just the part of it inside bbox. Returns the
+    lower-left corners lon and lat and a masked array, north first.
+    """
+    hf = tb.openFile(fname)
+    try:
+        a = hf.getNode('/', overview_name(level))
+        attrs = a._v_attrs
+        nrows, ncols = a.shape
+        lon = attrs.xllcorner + np.arange(ncols)*attrs.cellsize
+        lat = attrs.yllcorner + np.arange(nrows)*attrs.cellsize
+        if bbox is None:
+            data = a[:]
+        else:
+            llclati, llcloni, urclati, urcloni = bbox_indices(lon, lat, bbox)
+            data = a[nrows-urclati:nrows-llclati, llcloni:urcloni]
+            lon = lon[llcloni:urcloni]
+            lat = lat[llclati:urclati]
+        return lon, lat, np.ma.masked_equal(data, attrs.nodata_value)
+    finally:
+        hf.close()
+
+map_formats = {'flt': flt_writer, 'h5': h5_map_writer}
+
+def map_writer(fname, lon, lat, map_format='flt'):
+    "Returns a writer for a map in map_format, 'flt' or 'h5'. The writer replaces the extension of fname with its own."
+    if map_format not in map_formats:
+        raise ValueError, 'Unknown map format %s; should be one of %s.'%(map_format, ', '.join(sorted(map_formats)))
+    return map_formats[map_format](fname, lon, lat)
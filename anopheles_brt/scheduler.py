@@ -0,0 +1,204 @@
+# Copyright (C) 2009  Anand Patil
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Runs a graph of tasks, such as the stages in structure.dot for many species,
+# in a pool of processes. A task starts as soon as the tasks it depends on are
+# done, so different species' stages overlap. Each task runs in a fresh forked
+# process and hands its result back through a pipe, so results must pickle.
+
+import os
+import sys
+import time
+import traceback
+import multiprocessing
+
+__all__ = ['task', 'stage_scheduler', 'physical_memory']
+
+def physical_memory():
+    "The machine's physical memory in bytes."
+    return os.sysconf('SC_PAGE_SIZE')*os.sysconf('SC_PHYS_PAGES')
+
+class task(object):
+    """
+    A unit of work. fn is called with the results of the tasks named in
+    deps, in order, followed by args. memory is an estimate of the task's
+    peak memory footprint in bytes, and resources are the names of
+    resources, such as the database, that only one task may use at once.
+    """
+    def __init__(self, name, fn, deps=(), args=(), memory=0, resources=()):
+        self.name = name
+        self.fn = fn
+        self.deps = list(deps)
+        self.args = list(args)
+        self.memory = memory
+        self.resources = set(resources)
+
+    def __call__(self, dep_results):
+        return self.fn(*(dep_results + self.args))
+
+def run_task(conn, t, dep_results):
+    "Runs in the child process."
+    try:
+        result = ('done', t(dep_results))
+    except:
+        result = ('failed', ''.join(traceback.format_exception(*sys.exc_info())))
+    try:
+        conn.send(result)
+    except:
+        conn.send(('failed', 'Could not send the result of %s back:\n%s'%(t.name, ''.join(traceback.format_exception(*sys.exc_info())))))
+    conn.close()
+
+class stage_scheduler(object):
+    """
+    Runs tasks in up to n_processes processes at once, as their
+    dependencies are satisfied, in the order they were added.
+
+    - Tasks are admitted only while the summed memory estimates of the
+      running tasks stay within memory_budget. A task that does not fit
+      waits, and so do the tasks with memory estimates added after it, so
+      that large tasks are not starved. A task that would not fit even
+      on its own runs when nothing else is running.
+    - Tasks that share a resource never run at the same time.
+    - If a task fails, the tasks that depend on it are skipped, and
+      everything else carries on. status and errors record what happened.
+
+    With n_processes=0, the tasks run one at a time in this process, and
+    their results need not pickle.
+    """
+    def __init__(self, n_processes, memory_budget=None, poll_interval=.05):
+        self.n_processes = n_processes
+        self.memory_budget = memory_budget if memory_budget is not None else physical_memory()
+        self.poll_interval = poll_interval
+        self.tasks = []
+        self.by_name = {}
+        self.status = {}
+        self.results = {}
+        self.errors = {}
+
+    def add(self, name, fn, deps=(), args=(), memory=0, resources=()):
+        "Adds a task and returns its name, for use in other tasks' deps."
+        if name in self.by_name:
+            raise ValueError, 'There is already a task named %s.'%(name,)
+        for d in deps:
+            if d not in self.by_name:
+                raise ValueError, 'Task %s depends on %s, which has not been added.'%(name, d)
+        t = task(name, fn, deps, args, memory, resources)
+        self.tasks.append(t)
+        self.by_name[name] = t
+        self.status[name] = 'pending'
+        return name
+
+    def skip_dependents(self):
+        "Marks the pending tasks that depend on failed or skipped tasks as skipped."
+        for t in self.tasks:
+            if self.status[t.name] == 'pending' and any([self.status[d] in ['failed','skipped'] for d in t.deps]):
+                self.status[t.name] = 'skipped'
+
+    def ready(self):
+        return [t for t in self.tasks if self.status[t.name]=='pending' and all([self.status[d]=='done' for d in t.deps])]
+
+    def finish(self, name, status, result):
+        self.status[name] = status
+        if status == 'done':
+            self.results[name] = result
+        else:
+            self.errors[name] = result
+            print 'Task %s failed:\n%s'%(name, result)
+            self.skip_dependents()
+
+    def run_serial(self):
+        for t in self.tasks:
+            self.skip_dependents()
+            if self.status[t.name] != 'pending':
+                continue
+            self.status[t.name] = 'running'
+            try:
+                self.finish(t.name, 'done', t([self.results[d] for d in t.deps]))
+            except:
+                self.finish(t.name, 'failed', ''.join(traceback.format_exception(*sys.exc_info())))
+
+    def run(self):
+        "Runs every task. Returns status, a dictionary of final states by task name."
+        if self.n_processes == 0:
+            self.run_serial()
+            return self.status
+
+        running = {}
+        while True:
+            # Admit what can be admitted.
+            memory_used = sum([self.by_name[n].memory for n in running])
+            resources_used = set()
+            for n in running:
+                resources_used |= self.by_name[n].resources
+            memory_blocked = False
+            for t in self.ready():
+                if len(running) >= self.n_processes:
+                    break
+                if t.resources & resources_used:
+                    continue
+                if t.memory > 0:
+                    if memory_blocked:
+                        continue
+                    if running and memory_used + t.memory > self.memory_budget:
+                        memory_blocked = True
+                        continue
+                conn, child_conn = multiprocessing.Pipe(duplex=False)
+                p = multiprocessing.Process(target=run_task, args=(child_conn, t, [self.results[d] for d in t.deps]))
+                p.start()
+                child_conn.close()
+                running[t.name] = (p, conn)
+                self.status[t.name] = 'running'
+                memory_used += t.memory
+                resources_used |= t.resources
+
+            if not running:
+                break
+
+            # Collect whatever has finished.
+            finished = False
+            for n, (p, conn) in running.items():
+                if conn.poll():
+                    try:
+                        status, result = conn.recv()
+                    except EOFError:
+                        status, result = 'failed', 'The process running task %s exited with code %s without a result.'%(n, p.exitcode)
+                    p.join()
+                elif not p.is_alive():
+                    p.join()
+                    if conn.poll():
+                        continue
+                    status, result = 'failed', 'The process running task %s exited with code %s without a result.'%(n, p.exitcode)
+                else:
+                    continue
+                del running[n]
+                self.finish(n, status, result)
+                finished = True
+            if not finished:
+                time.sleep(self.poll_interval)
+
+        return self.status
+
+    def report(self):
+        "Returns a list of lines summarising the outcome."
+        counts = {}
+        for s in self.status.itervalues():
+            counts[s] = counts.get(s, 0) + 1
+        lines = ['%i tasks: '%len(self.tasks) + ', '.join(['%i %s'%(v,k) for k, v in sorted(counts.iteritems())])]
+        for t in self.tasks:
+            if self.status[t.name] == 'failed':
+                lines.append('%s failed: %s'%(t.name, self.errors[t.name].strip().splitlines()[-1]))
+            elif self.status[t.name] == 'skipped':
+                lines.append('%s skipped'%(t.name,))
+        return lines
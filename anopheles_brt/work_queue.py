@@ -0,0 +1,201 @@
+# Copyright (C) 2009  Anand Patil
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Jobs shared between any number of processes, on any number of machines,
+# through a directory on a shared filesystem. A process claims a job by
+# writing a lease file and keeps it by touching the file. If the process dies,
+# its leases stop being touched, expire, and are claimed by someone else.
+#
+#   dirname/jobs/<name>.json     what to do, written once by add
+#   dirname/leases/<name>.lease  who is doing it
+#   dirname/done/<name>.json     how it went
+
+import os
+import time
+import json
+import socket
+import threading
+from caching import cache_lock
+
+__all__ = ['work_queue']
+
+def write_json(fname, obj):
+    "Writes obj to fname through a temporary file and a rename, so readers never see half of it."
+    tmp = '%s.%s.%i.tmp'%(fname, socket.gethostname(), os.getpid())
+    json.dump(obj, file(tmp,'w'))
+    os.rename(tmp, fname)
+
+def read_json(fname):
+    "Returns the contents of a file written by write_json, or None if there is none."
+    try:
+        return json.load(file(fname))
+    except IOError:
+        return None
+
+class work_queue(object):
+    """
+    A queue of named jobs in the directory dirname.
+
+    - claim() leases jobs that are neither done nor leased, or whose
+      leases have not been renewed for lease_seconds. Claims are made
+      under a lock on the directory, so a job goes to one process at a time.
+    - heartbeat() renews this process's leases, and start_heartbeats()
+      does it in a background thread every lease_seconds/4.
+    - finish() records a job's outcome and gives up its lease. Failed
+      jobs are done too, and are not retried; only jobs whose owners die
+      are claimed again.
+
+    Lease ages are measured against the shared filesystem's clock, by
+    touching a file in dirname, so the machines' clocks need not agree.
+    """
+    def __init__(self, dirname, lease_seconds=600):
+        self.dirname = dirname
+        self.lease_seconds = lease_seconds
+        self.node = '%s:%i'%(socket.gethostname(), os.getpid())
+        self.held = set()
+        self.lost = set()
+        self.heartbeat_thread = None
+        self.stopping = threading.Event()
+        for d in ['jobs','leases','done']:
+            try:
+                os.makedirs(os.path.join(dirname, d))
+            except OSError:
+                pass
+
+    def path(self, kind, name):
+        return os.path.join(self.dirname, kind, name + {'jobs': '.json', 'leases': '.lease', 'done': '.json'}[kind])
+
+    def add(self, name, job):
+        "Adds a job, which must be JSON-serializable, unless one named name is already there. Returns whether it was added."
+        if os.path.exists(self.path('jobs', name)):
+            return False
+        write_json(self.path('jobs', name), job)
+        return True
+
+    def names(self):
+        return sorted([os.path.splitext(f)[0] for f in os.listdir(os.path.join(self.dirname, 'jobs')) if f.endswith('.json')])
+
+    def job(self, name):
+        return read_json(self.path('jobs', name))
+
+    def outcome(self, name):
+        "The record written by finish, or None if the job is not done."
+        return read_json(self.path('done', name))
+
+    def now(self):
+        "The shared filesystem's current time."
+        clock = os.path.join(self.dirname, '.clock.%s'%self.node)
+        file(clock,'w').close()
+        t = os.path.getmtime(clock)
+        os.remove(clock)
+        return t
+
+    def lease_age(self, name, now=None):
+        "Seconds since the lease on name was last renewed, or None if there is none."
+        try:
+            t = os.path.getmtime(self.path('leases', name))
+        except OSError:
+            return None
+        return (now if now is not None else self.now()) - t
+
+    def owner(self, name):
+        lease = read_json(self.path('leases', name))
+        return lease['node'] if lease is not None else None
+
+    def claim(self, max_jobs=1):
+        """
+        Leases up to max_jobs jobs that are neither done nor held by a
+        live process, in order of name. Returns a list of (name, job)
+        tuples, empty if there is nothing to claim at the moment.
+        """
+        claimed = []
+        l = cache_lock(os.path.join(self.dirname, '.claim.lock'))
+        l.acquire()
+        try:
+            now = self.now()
+            for name in self.names():
+                if len(claimed) >= max_jobs:
+                    break
+                if os.path.exists(self.path('done', name)):
+                    continue
+                age = self.lease_age(name, now)
+                if age is not None and age < self.lease_seconds:
+                    continue
+                if age is not None:
+                    print 'Reclaiming job %s from %s, whose lease expired %i seconds ago.'%(name, self.owner(name), age-self.lease_seconds)
+                write_json(self.path('leases', name), {'node': self.node, 'claimed': now})
+                self.held.add(name)
+                claimed.append((name, self.job(name)))
+        finally:
+            l.release()
+        return claimed
+
+    def waiting(self):
+        "The names of the jobs that are neither done nor claimable, because another process holds them."
+        now = self.now()
+        out = []
+        for name in self.names():
+            if os.path.exists(self.path('done', name)) or name in self.held:
+                continue
+            age = self.lease_age(name, now)
+            if age is not None and age < self.lease_seconds:
+                out.append(name)
+        return out
+
+    def heartbeat(self):
+        """
+        Renews the leases this process holds. A lease that another process
+        has taken over, because this one went too long without renewing
+        it, is given up and added to lost.
+        """
+        for name in list(self.held):
+            if self.owner(name) != self.node:
+                print 'Lost the lease on job %s to %s.'%(name, self.owner(name))
+                self.held.discard(name)
+                self.lost.add(name)
+                continue
+            try:
+                os.utime(self.path('leases', name), None)
+            except OSError:
+                pass
+
+    def start_heartbeats(self):
+        "Renews the leases every lease_seconds/4 in a background thread, until stop_heartbeats is called."
+        def beat():
+            while not self.stopping.wait(self.lease_seconds/4.):
+                self.heartbeat()
+        self.stopping.clear()
+        self.heartbeat_thread = threading.Thread(target=beat)
+        self.heartbeat_thread.daemon = True
+        self.heartbeat_thread.start()
+
+    def stop_heartbeats(self):
+        self.stopping.set()
+        if self.heartbeat_thread is not None:
+            self.heartbeat_thread.join()
+            self.heartbeat_thread = None
+
+    def finish(self, name, status, info=None):
+        """
+        Records status, for example 'done' or 'failed', and info for the
+        job, and gives up its lease. Does nothing if the lease was lost,
+        because the job now belongs to another process.
+        """
+        if name not in self.held or self.owner(name) != self.node:
+            self.held.discard(name)
+            return
+        write_json(self.path('done', name), {'status': status, 'node': self.node, 'finished': self.now(), 'info': info})
+        os.remove(self.path('leases', name))
+        self.held.discard(name)
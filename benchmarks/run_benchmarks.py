@@ -0,0 +1,210 @@
+# Copyright (C) 2009  Anand Patil
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Times each stage of the pipeline on synthetic data at several sizes, and
+# compares the timings and a few checks on the results with a stored baseline.
+# The database is replaced by the stand-in in benchmarks/standin, and the BRT
+# is fitted by the NumPy backend, so neither the MAP database nor R is needed.
+#
+#   python benchmarks/run_benchmarks.py                     # compare with baseline.json
+#   python benchmarks/run_benchmarks.py -z small --save-baseline
+#
+# Every size runs in a fresh directory with its own cache, so each stage does
+# its work from scratch. The exit status is 1 if a stage got slower than the
+# tolerance allows or a check changed. The run stops with an error if the
+# presence rows are not exactly the points of the sites where the species
+# was found.
+
+import os, sys
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(bench_dir, 'standin'))
+sys.path.insert(1, os.path.dirname(bench_dir))
+
+import warnings
+warnings.simplefilter('ignore')
+import matplotlib
+matplotlib.use('pdf')
+import json
+import shutil
+import tempfile
+import platform
+import numpy as np
+from optparse import OptionParser
+
+import anopheles_brt
+from anopheles_query import Session, register_species
+from synthetic import synthetic_layers, synthetic_glob, synthetic_species
+
+# Rasters cover bbox at cells_per_degree; sites are the number of records
+# returned by species_query.
+sizes = {'small': {'cells_per_degree': 10, 'n_layers': 4, 'n_classes': 3, 'n_sites': 200, 'n_pseudoabsences': 500},
+         'medium': {'cells_per_degree': 30, 'n_layers': 8, 'n_classes': 5, 'n_sites': 1000, 'n_pseudoabsences': 2000},
+         'large': {'cells_per_degree': 60, 'n_layers': 12, 'n_classes': 8, 'n_sites': 4000, 'n_pseudoabsences': 10000}}
+size_order = ['small', 'medium', 'large']
+
+bbox = (-20., -20., 20., 20.)
+buffer_width = 2.
+brt_opts = {'backend': 'numpy', 'seed': 0, 'learning.rate': 0.05, 'bag.fraction': 0.75, 'n.trees': 50}
+
+# Stages whose records are timed, in pipeline order.
+stages = ['prefetch_sites', 'sites_as_ndarray', 'get_pseudoabsences', 'extract_environment_batch', 'brt', 'trees_to_diagnostics', 'trees_to_maps_tiled']
+
+def run_size(size, workdir, seed):
+    """
+    Runs the pipeline for one synthetic species at the given size in
+    workdir. Returns the per-stage summaries of the profiling log and a
+    dictionary of checks on the results.
+    """
+    params = sizes[size]
+    os.chdir(workdir)
+    anopheles_brt.anopheles_cache.dirname = os.path.join(workdir, 'anopheles-caches')
+    anopheles_brt.anopheles_cache.index = None
+
+    layer_names = synthetic_layers(workdir, bbox, params['cells_per_degree'], params['n_layers'], seed)
+    glob_name, glob_channels = synthetic_glob(workdir, bbox, params['cells_per_degree'], params['n_classes'], seed)
+    sites, eo = synthetic_species(bbox, params['n_sites'], seed=seed)
+    species_name = 'Anopheles synthetica %s'%size
+    register_species(1, species_name, sites, eo)
+    species = (1, species_name)
+
+    profile_fname = os.path.join(workdir, 'benchmark-profile.jsonl')
+    anopheles_brt.profile_to(profile_fname, size=size)
+    try:
+        anopheles_brt.prefetch_sites(Session(), [species])
+        breaks, site_x, found, zero, others_found, multipoints, eo = anopheles_brt.sites_as_ndarray(Session(), species)
+        anopheles_brt.get_pseudoabsences(eo, buffer_width, params['n_pseudoabsences'], layer_names, glob_name, seed, species_name)
+        fname, pseudoabsences, x = anopheles_brt.sites_and_env(Session(), species, layer_names, glob_name, glob_channels, buffer_width, params['n_pseudoabsences'], seed=seed)
+        brt_res = anopheles_brt.brt(fname, species_name, brt_opts)
+        nice_tree_dict = anopheles_brt.unpack_brt_trees(brt_res, layer_names, glob_name, glob_channels)
+        intercept = anopheles_brt.unpack_gbm_object(brt_res, 'initF')[0][0]
+        be = anopheles_brt.brt_evaluator(nice_tree_dict, intercept, compiled=True, glob_name=glob_name, glob_channels=glob_channels)
+        anopheles_brt.trees_to_diagnostics(be, fname, species_name)
+        lon, lat, map_fname = anopheles_brt.trees_to_map_tiled(be, species_name, layer_names, glob_name, glob_channels, bbox)
+    finally:
+        anopheles_brt.profile_to(None)
+
+    # Every point of every site where the species was found is a presence
+    # row, whether the site is a point or a multipoint.
+    presence_rows = len(x)-len(pseudoabsences)
+    found_points = int(np.diff(breaks)[found>0].sum())
+    if presence_rows != found_points:
+        raise ValueError, 'There are %i presence rows, but %i points in sites where the species was found.'%(presence_rows, found_points)
+
+    prob = np.fromfile(map_fname, dtype='float32')
+    prob = prob[prob != float(anopheles_brt.read_hdr(os.path.splitext(map_fname)[0]+'.hdr')['nodata_value'])]
+    checks = {'sites': len(breaks)-1,
+              'points': len(site_x),
+              'presence_rows': presence_rows,
+              'training_rows': len(anopheles_brt.load_training_table(fname)),
+              'n_trees': int(anopheles_brt.unpack_gbm_object(brt_res, 'n.trees')[0]),
+              'map_pixels': len(lon)*len(lat),
+              'map_mean': float(prob.mean())}
+    return anopheles_brt.summarize_profiles([profile_fname]), checks
+
+def compare(results, baseline, tolerance, min_seconds):
+    """
+    Returns a list of lines comparing results with baseline, and whether
+    anything regressed. A stage regresses if it took more than
+    (1+tolerance) times as long as in the baseline, and at least
+    min_seconds longer. Integer checks must match exactly, and the others
+    to a relative error of 1e-6.
+    """
+    lines = []
+    regressed = False
+    for size in [s for s in size_order if s in results]:
+        if size not in baseline:
+            lines.append('%s: not in the baseline.'%size)
+            continue
+        for stage in stages:
+            new = results[size]['stages'].get(stage, {}).get('wall')
+            old = baseline[size]['stages'].get(stage, {}).get('wall')
+            if new is None or old is None:
+                continue
+            slow = new > (1+tolerance)*old and new-old >= min_seconds
+            regressed |= slow
+            lines.append('%-8s %-26s %9.3fs %9.3fs %+7.1f%%%s'%(size, stage, old, new, 100*(new-old)/max(old,1e-9), '  SLOWER' if slow else ''))
+        for k, new in sorted(results[size]['checks'].iteritems()):
+            old = baseline[size]['checks'].get(k)
+            if isinstance(new, float) and old is not None:
+                same = abs(new-old) <= 1e-6*max(abs(old),1e-12)
+            else:
+                same = new == old
+            if not same:
+                regressed = True
+                lines.append('%-8s check %s changed from %s to %s'%(size, k, old, new))
+    return lines, regressed
+
+if __name__ == '__main__':
+    p = OptionParser('usage: %prog [options]')
+    p.add_option('-z','--sizes',help='Comma-separated sizes to run, from %s. Defaults to all of them.'%', '.join(size_order),dest='sizes')
+    p.add_option('-b','--baseline',help='Baseline file. Defaults to baseline.json next to this script.',dest='baseline')
+    p.add_option('-s','--save-baseline',help='Write the results to the baseline file instead of comparing with it.',dest='save_baseline',action='store_true')
+    p.add_option('-t','--tolerance',help='Fractional slowdown of a stage that counts as a regression. Defaults to 0.25.',dest='tolerance',type='float')
+    p.add_option('-m','--min-seconds',help='Slowdowns shorter than this many seconds are ignored. Defaults to 0.05.',dest='min_seconds',type='float')
+    p.add_option('-k','--keep',help='Keep the working directories, and print where they are.',dest='keep',action='store_true')
+    p.add_option('-r','--seed',help='Seed for the synthetic data, pseudoabsences and BRT. Defaults to 0.',dest='seed',type='int')
+
+    p.set_defaults(sizes=','.join(size_order))
+    p.set_defaults(baseline=os.path.join(bench_dir, 'baseline.json'))
+    p.set_defaults(tolerance=0.25)
+    p.set_defaults(min_seconds=0.05)
+    p.set_defaults(seed=0)
+
+    (o, args) = p.parse_args()
+
+    run_sizes = o.sizes.split(',')
+    for size in run_sizes:
+        if size not in sizes:
+            p.error('Unknown size %s.'%size)
+
+    cwd = os.getcwd()
+    results = {}
+    for size in run_sizes:
+        workdir = tempfile.mkdtemp(prefix='anopheles-benchmark-%s-'%size)
+        print 'Running the %s benchmark in %s.'%(size, workdir)
+        try:
+            stage_summaries, checks = run_size(size, workdir, o.seed)
+        finally:
+            os.chdir(cwd)
+            if not o.keep:
+                shutil.rmtree(workdir)
+        results[size] = {'params': sizes[size], 'stages': stage_summaries, 'checks': checks}
+        for stage in stages:
+            if stage in stage_summaries:
+                print '    %-26s %9.3fs'%(stage, stage_summaries[stage]['wall'])
+
+    machine = {'node': platform.node(), 'machine': platform.machine(), 'python': platform.python_version(), 'numpy': np.__version__}
+
+    if o.save_baseline:
+        baseline = {}
+        if os.path.exists(o.baseline):
+            baseline = json.load(file(o.baseline))
+        baseline.update(results)
+        baseline['machine'] = machine
+        json.dump(baseline, file(o.baseline,'w'), indent=1, sort_keys=True)
+        print 'Wrote the baseline for %s to %s.'%(', '.join(run_sizes), o.baseline)
+        sys.exit(0)
+
+    if not os.path.exists(o.baseline):
+        print 'There is no baseline at %s; run with --save-baseline to make one.'%o.baseline
+        sys.exit(0)
+
+    baseline = json.load(file(o.baseline))
+    if baseline.get('machine') != machine:
+        print 'The baseline was recorded on a different machine or software stack, %s; timings may not be comparable.'%baseline.get('machine')
+    lines, regressed = compare(results, baseline, o.tolerance, o.min_seconds)
+    for line in lines:
+        print line
+    sys.exit(1 if regressed else 0)
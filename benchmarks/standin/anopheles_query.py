@@ -0,0 +1,52 @@
+# Copyright (C) 2009  Anand Patil
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# An in-memory stand-in for the anopheles_query module, for benchmarks. Put
+# this directory at the front of sys.path before importing anopheles_brt, and
+# register synthetic species with register_species; nothing touches the MAP
+# database.
+
+__all__ = ['Session', 'IncompleteDataError', 'register_species', 'list_species', 'species_query']
+
+registry = {}
+
+class IncompleteDataError(Exception):
+    pass
+
+class Session(object):
+    "Stands in for the SQLAlchemy session; the registry is shared by all of them."
+    def close(self):
+        pass
+
+def register_species(species_id, name, sites, eo):
+    """
+    Registers a species. sites is a list of (geometry, found, zero,
+    others_found, total) tuples, where geometry is a shapely Point or
+    MultiPoint, and eo is a shapely Polygon or MultiPolygon, as
+    species_query returns them.
+    """
+    registry[species_id] = (name, sites, eo)
+
+def list_species(session):
+    "Returns a list of (id, name) tuples."
+    return [(k, v[0]) for k, v in sorted(registry.iteritems())]
+
+def species_query(session, species_id):
+    "Returns the sites and extent of occurrence of a species."
+    try:
+        name, sites, eo = registry[species_id]
+    except KeyError:
+        raise IncompleteDataError, 'No species with id %s has been registered.'%species_id
+    return list(sites), eo
@@ -0,0 +1,113 @@
+# Copyright (C) 2009  Anand Patil
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Synthetic environmental layers, glob rasters and species for benchmarks.
+# Everything is generated from a seed, so the same arguments always give the
+# same files and geometries.
+
+import os
+import numpy as np
+from shapely.geometry import Point, MultiPoint, Polygon
+from anopheles_brt.raster_tiles import write_hdr
+
+__all__ = ['land_mask', 'smooth_field', 'write_synthetic_raster', 'synthetic_layers', 'synthetic_glob', 'ellipse', 'synthetic_species']
+
+def land_mask(lon, lat, bbox):
+    "True inside an ellipse filling most of the bbox (llclat, llclon, urclat, urclon); the rest is sea."
+    llclat, llclon, urclat, urclon = bbox
+    cx, cy = (llclon+urclon)/2., (llclat+urclat)/2.
+    rx, ry = .45*(urclon-llclon), .45*(urclat-llclat)
+    return ((lon[None,:]-cx)/rx)**2 + ((lat[:,None]-cy)/ry)**2 < 1
+
+def smooth_field(lon, lat, random_state, n_waves=6):
+    "A sum of randomly oriented sinusoids with wavelengths of a few degrees."
+    out = np.zeros((len(lat), len(lon)))
+    for i in xrange(n_waves):
+        k = random_state.uniform(.1, 1., size=2)*random_state.choice([-1,1], size=2)
+        phase = random_state.uniform(0, 2*np.pi)
+        out += np.sin(k[0]*lon[None,:] + k[1]*lat[:,None] + phase)*random_state.uniform(.5,1.5)
+    return out
+
+def write_synthetic_raster(fname, bbox, cells_per_degree, values, nodata=-9999, chunk_rows=256):
+    """
+    Writes a float32 .flt/.hdr pair covering bbox. values(lon, lat) is
+    called with the pixel centroids of a window of rows, from the north,
+    and returns a masked array of the window's values.
+    """
+    llclat, llclon, urclat, urclon = bbox
+    cellsize = 1./cells_per_degree
+    ncols = int(round((urclon-llclon)*cells_per_degree))
+    nrows = int(round((urclat-llclat)*cells_per_degree))
+    base = os.path.splitext(fname)[0]
+    write_hdr(base+'.hdr', ncols, nrows, llclon, llclat, cellsize, nodata)
+    lon = llclon + (np.arange(ncols)+.5)*cellsize
+    # Row 0 is the northernmost.
+    lat = llclat + (np.arange(nrows)[::-1]+.5)*cellsize
+    fout = file(base+'.flt','wb')
+    for start in xrange(0, nrows, chunk_rows):
+        np.ma.filled(values(lon, lat[start:start+chunk_rows]), nodata).astype('float32').tofile(fout)
+    fout.close()
+    return base
+
+def synthetic_layers(dirname, bbox, cells_per_degree, n_layers, seed=0):
+    "Writes n_layers smooth environmental layers, masked to the land. Returns their names."
+    names = []
+    for i in xrange(n_layers):
+        def values(lon, lat, i=i):
+            field = smooth_field(lon, lat, np.random.RandomState(seed*1000+i))
+            return np.ma.masked_array(field, mask=~land_mask(lon, lat, bbox))
+        names.append(write_synthetic_raster(os.path.join(dirname, 'layer%i'%i), bbox, cells_per_degree, values))
+    return names
+
+def synthetic_glob(dirname, bbox, cells_per_degree, n_classes, seed=0):
+    "Writes a land-cover raster with classes 1 to n_classes. Returns its name and the channels."
+    def values(lon, lat):
+        field = smooth_field(lon, lat, np.random.RandomState(seed*1000+999))
+        classes = np.floor((np.arctan(field)/np.pi+.5)*n_classes) + 1
+        return np.ma.masked_array(classes, mask=~land_mask(lon, lat, bbox))
+    return write_synthetic_raster(os.path.join(dirname, 'glob'), bbox, cells_per_degree, values), range(1, n_classes+1)
+
+def ellipse(cx, cy, rx, ry, n=64):
+    t = np.linspace(0, 2*np.pi, n, endpoint=False)
+    return Polygon(zip(cx + rx*np.cos(t), cy + ry*np.sin(t)))
+
+def synthetic_species(bbox, n_sites, multipoint_fraction=.1, seed=0):
+    """
+    Returns sites and an extent of occurrence in the form species_query
+    returns them. The EO is an ellipse well inside the land, and the sites
+    are points and multipoints scattered over it, about half of them with
+    the species found.
+    """
+    random_state = np.random.RandomState(seed)
+    llclat, llclon, urclat, urclon = bbox
+    cx = llclon + (urclon-llclon)*random_state.uniform(.4,.6)
+    cy = llclat + (urclat-llclat)*random_state.uniform(.4,.6)
+    rx, ry = .2*(urclon-llclon), .2*(urclat-llclat)
+    eo = ellipse(cx, cy, rx, ry)
+
+    sites = []
+    for i in xrange(n_sites):
+        r = np.sqrt(random_state.uniform())
+        t = random_state.uniform(0, 2*np.pi)
+        x, y = cx + .9*rx*r*np.cos(t), cy + .9*ry*r*np.sin(t)
+        if random_state.uniform() < multipoint_fraction:
+            geom = MultiPoint([(x + random_state.normal(0,.05), y + random_state.normal(0,.05)) for j in xrange(random_state.randint(2,4))])
+        else:
+            geom = Point(x, y)
+        found = random_state.poisson(3) if random_state.uniform() < .5 else 0
+        zero = 0 if found else 1
+        others = random_state.poisson(1)
+        sites.append((geom, found, zero, others, found+others))
+    return sites, eo
@@ -8,6 +8,10 @@ config = Configuration('anopheles_brt',parent_package=None,top_path=None)
 config.add_extension(name='treetran', sources=['anopheles_brt/treetran.f'])
 
 config.packages = ["anopheles_brt"]
+
+# Installed below with a #! line, which the scripts themselves lack.
+scripts = ['anopheles-brt', 'anopheles-r-workers', 'anopheles-model-server']
+
 if __name__ == '__main__':
     from numpy.distutils.core import setup
     setup(**(config.todict()))
@@ -18,5 +22,6 @@ if __name__ == '__main__':
         bin = '/usr/bin'
     #bin = '/Users/marianne/bin'
         
-    file('/Users/marianne/bin/anopheles-brt','w').write('#!%s/python\n\n'%bin+file('anopheles-brt').read())
-    os.system('chmod ugo+x /Users/marianne/bin/anopheles-brt')
+    for script in scripts:
+        file('/Users/marianne/bin/%s'%script,'w').write('#!%s/python\n\n'%bin+file(script).read())
+        os.system('chmod ugo+x /Users/marianne/bin/%s'%script)